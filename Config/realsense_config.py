@@ -22,11 +22,40 @@ HAND_EYE_TFMATRIX=np.array([
     [0,0,1,0.018],
     [0,0,0,1]
 ])
+# 改了這些內參的話 ray grid的cache就要重算
+INTRINSIC_NAMES=('cx','cy','fx','fy','scalingfactor')
 class RGBDCamera():
     def __init__(self, centerx=cx,centery=cy,focalx=fx,focaly=fy,scalingfactor=scalingfactor):
+        self._ray_grids={}
         self.cx =centerx
         self.cy=centery
         self.fx=focalx
         self.fy=focaly
         self.scalingfactor=scalingfactor
-
+    def __setattr__(self,name,value):
+        if name in INTRINSIC_NAMES:
+            # invalidate all cached resolutions
+            self.__dict__['_ray_grids']={}
+        object.__setattr__(self,name,value)
+    """
+    Per-pixel ray lookup table
+    grid[v,u]=((u-cx)*s/fx, (v-cy)*s/fy, s), s is the depth scaling factor
+    so the camera-frame xyz of a raw depth frame is depth[...,None]*grid
+    The grids are built lazily and cached for every (width,height),
+    ex: 640x480 and 1280x720 streams can share the same camera object.
+    """
+    def ray_grid(self,width,height):
+        grids=self._ray_grids
+        grid=grids.get((width,height))
+        if grid is None:
+            s=self.scalingfactor
+            grid=np.empty((height,width,3),dtype=np.float32)
+            grid[:,:,0]=((np.arange(width)-self.cx)*s/self.fx)[np.newaxis,:]
+            grid[:,:,1]=((np.arange(height)-self.cy)*s/self.fy)[:,np.newaxis]
+            grid[:,:,2]=s
+            grids[(width,height)]=grid
+        return grid
+    # (H,W) raw depth -> (H,W,3) xyz in camera frame (unit: meter)
+    def depth_to_xyz(self,depth):
+        depth=np.asarray(depth)
+        return depth[...,np.newaxis]*self.ray_grid(depth.shape[1],depth.shape[0])
@@ -0,0 +1,118 @@
+"""
+Persistent MaskRCNN result cache.
+The key is the sha1 of the image bytes(+shape,dtype), the weights file(path, size and mtime,
+so a retrained model never hits old results) and the target label.
+Each result is stored as a compressed CompactMask(bbox + packed bits) in directory/<key>.npz,
+"no instance" results are cached too. The least recently used files are removed when the total size of
+the cache is over max_bytes.
+EX:
+cache=MaskCache("mask_cache",MODEL_PATH)
+mask=cache.get_or_compute(image,'cup',worker.generate_mask)
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from Utils.compact_mask import CompactMask
+
+class MaskCache():
+    def __init__(self,directory,weights_path,max_bytes=256*1024*1024):
+        self.directory=directory
+        self.max_bytes=max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        weights=weights_path
+        if os.path.isfile(weights_path):
+            stat=os.stat(weights_path)
+            weights="%s:%d:%d" % (weights_path,stat.st_size,int(stat.st_mtime))
+        self._weights_key=weights.encode('utf-8')
+        self._lock=threading.Lock()
+        # key -> file size, ordered from the least recently used
+        self._entries=OrderedDict()
+        self._total=0
+        files=[name for name in os.listdir(directory) if name.endswith('.npz')]
+        files.sort(key=lambda name: os.path.getmtime(os.path.join(directory,name)))
+        for name in files:
+            size=os.path.getsize(os.path.join(directory,name))
+            self._entries[name[:-4]]=size
+            self._total+=size
+    def key(self,image,label):
+        image=np.ascontiguousarray(image)
+        digest=hashlib.sha1()
+        digest.update(("%s|%s|" % (image.shape,image.dtype.str)).encode('utf-8'))
+        digest.update(memoryview(image).cast('B'))
+        digest.update(b"|"+self._weights_key+b"|"+label.encode('utf-8'))
+        return digest.hexdigest()
+    """
+    return (hit, mask)
+    mask is a CompactMask, or None if the model found no instance of label
+    """
+    def get(self,image,label):
+        return self._get(self.key(image,label))
+    def put(self,image,label,mask):
+        self._put(self.key(image,label),mask)
+    # compute(label,image) is only called on a miss, ex: MaskRCNNWorker.generate_mask
+    def get_or_compute(self,image,label,compute):
+        # the full image is hashed only once
+        key=self.key(image,label)
+        hit,mask=self._get(key)
+        if hit:
+            return mask
+        mask=compute(label,image)
+        self._put(key,mask)
+        return mask
+    def _get(self,key):
+        path=self._path(key)
+        with self._lock:
+            if key not in self._entries:
+                return False,None
+            self._entries.move_to_end(key)
+        try:
+            with np.load(path) as data:
+                if not data['found']:
+                    return True,None
+                mask=CompactMask(data['shape'],data['bbox'],data['bits'],data['count'])
+            os.utime(path)
+        except (OSError,KeyError,ValueError):
+            # removed, broken or older format file, just compute it again
+            self._remove(key)
+            return False,None
+        return True,mask
+    def _put(self,key,mask):
+        path=self._path(key)
+        # unique temp file: two requests can miss on the same frame at the same time
+        with tempfile.NamedTemporaryFile(dir=self.directory,prefix=key,suffix=".tmp",delete=False) as file:
+            temp_path=file.name
+            if mask is None:
+                np.savez_compressed(file,found=False)
+            else:
+                if not isinstance(mask,CompactMask):
+                    mask=CompactMask.from_dense(mask)
+                np.savez_compressed(file,found=True,shape=np.array(mask.shape),bbox=np.array(mask.bbox),
+                                    bits=mask.bits,count=mask.count)
+        size=os.path.getsize(temp_path)
+        os.replace(temp_path,path)
+        with self._lock:
+            self._total+=size-self._entries.pop(key,0)
+            self._entries[key]=size
+            evicted=[]
+            while self._total>self.max_bytes and len(self._entries)>1:
+                old_key,old_size=self._entries.popitem(last=False)
+                self._total-=old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+    def _path(self,key):
+        return os.path.join(self.directory,key+".npz")
+    def _remove(self,key):
+        with self._lock:
+            self._total-=self._entries.pop(key,0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
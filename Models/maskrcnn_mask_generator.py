@@ -2,6 +2,7 @@
 This function is mainly implemented to generate the mask from MaskRCNN.
 In order to use it properly, you need to set up your MaskRCNN folder in the Model directory which
 is the same with this file. Furthermore, you need to properly set up your weights correctly on MODEL_PATH
+(in maskrcnn_paths.py)
 
 """
 import os
@@ -11,8 +12,9 @@ import math
 import numpy as np
 import cv2
 import tensorflow as tf
-FILE_ABSDIR = os.path.abspath(os.path.dirname(__file__))
-ROOT_DIR=FILE_ABSDIR+"/"+"MaskRCNN"
+# ROOT_DIR, MODEL_DIR, MODEL_PATH and IMAGE_DIR are set up in maskrcnn_paths.py
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from Models.maskrcnn_paths import FILE_ABSDIR,ROOT_DIR,MODEL_DIR,MODEL_PATH,IMAGE_DIR
 # Root directory of the project
 print("Directory of MaskRCNN is: ",ROOT_DIR)
  
@@ -22,14 +24,7 @@ from mrcnn.config import Config
 from mrcnn import utils
 import mrcnn.model as modellib
  
-# Directory to save logs and trained model
-MODEL_DIR = os.path.join(ROOT_DIR, "logs")
 print(MODEL_DIR)
-# Local path to trained weights file
-MODEL_PATH = os.path.join(MODEL_DIR ,"shapes20191113T1842/mask_rcnn_shapes_0030.h5")
-
-# Directory of images to run detection on
-IMAGE_DIR = os.path.join(ROOT_DIR, "images")
  
 class ShapesConfig(Config):
     """Configuration for training on the toy shapes dataset.
@@ -72,14 +67,19 @@ class InferenceConfig(ShapesConfig):
     # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
     GPU_COUNT = 1
     IMAGES_PER_GPU = 1
+    # images_per_gpu>1 is used by the micro-batching of the MaskRCNN worker
+    def __init__(self,images_per_gpu=1):
+        self.IMAGES_PER_GPU=images_per_gpu
+        super(InferenceConfig,self).__init__()
 
 
 
 class MaskGenerator:
-    config=InferenceConfig()
 
-    def __init__(self,class_names):
+    # batch_size: images per model.detect call, see detect_batch
+    def __init__(self,class_names,batch_size=1):
         self.class_names=class_names
+        self.config=InferenceConfig(batch_size)
         print("Create MaskRCNN detector!!!")
     def load_model(self):
         # config=tf.ConfigProto()
@@ -95,21 +95,61 @@ class MaskGenerator:
 
                 # Load weights trained on MS-COCO
                 self.model.load_weights(MODEL_PATH, by_name=True)
-    def generateMask(self,label,image):
-
+    def detect(self,image):
+        return self.detect_batch([image])[0]
+    """
+    Detect several images with as few model.detect calls as possible
+    The graph is built for exactly config.BATCH_SIZE images, so a partial batch is padded
+    with its last image and the padded results are dropped.
+    return: one result dict(rois, class_ids, scores, masks) per image
+    """
+    def detect_batch(self,images):
+        batch_size=self.config.BATCH_SIZE
+        results=[]
         with self.graph.as_default():
             with self.session.as_default():
-                print("graph is: ",self.graph)
-                results=self.model.detect([image], verbose=1)
-                r = results[0]
-                target_index=self.class_names.index(label)
-                # can find the instance
-                if(target_index in r['class_ids']):
-                    idx=list(r['class_ids']).index(target_index)
-                    return   r['masks'][:,:,idx].astype(int)
-                # if not
-                else:
-                    return None
+                for start in range(0,len(images),batch_size):
+                    batch=list(images[start:start+batch_size])
+                    count=len(batch)
+                    batch+=[batch[-1]]*(batch_size-count)
+                    results+=self.model.detect(batch, verbose=1)[:count]
+        return results
+    def generateMask(self,label,image):
+        return self.first_mask(self.detect(image),label)
+    # mask of the first instance of label in a detect() result
+    def first_mask(self,r,label):
+        target_index=self.class_names.index(label)
+        # can find the instance
+        if(target_index in r['class_ids']):
+            idx=list(r['class_ids']).index(target_index)
+            return   r['masks'][:,:,idx].astype(np.uint8)
+        # if not
+        else:
+            return None
+    """
+    Multi-label detection with only one forward pass
+    labels: list of class names, ex: ['cup','tape']
+    min_score: instances with lower score are dropped
+    top_k: keep at most top_k instances per label(None means all)
+    return:
+    dict of label -> list of instances sorted by score, each instance is
+    {'score': float, 'bbox': [y1,x1,y2,x2], 'mask': (H,W) bool nparray}
+    """
+    def generateMasks(self,labels,image,min_score=0.0,top_k=None):
+        return self.collect_instances(self.detect(image),labels,min_score,top_k)
+    def collect_instances(self,r,labels,min_score=0.0,top_k=None):
+        instances={}
+        for label in labels:
+            target_index=self.class_names.index(label)
+            idx=[i for i in np.argsort(-r['scores']) if r['class_ids'][i]==target_index and r['scores'][i]>=min_score]
+            if top_k is not None:
+                idx=idx[:top_k]
+            instances[label]=[{
+                'score':float(r['scores'][i]),
+                'bbox':[int(value) for value in r['rois'][i]],
+                'mask':r['masks'][:,:,i]
+            } for i in idx]
+        return instances
 
 
 if __name__=="__main__":
@@ -0,0 +1,14 @@
+"""
+Paths of the MaskRCNN folder and weights.
+They are kept here without importing TensorFlow, so the flask server can use them
+(ex: as the key of the mask cache) while the model itself lives in the worker process.
+"""
+import os
+FILE_ABSDIR = os.path.abspath(os.path.dirname(__file__))
+ROOT_DIR=FILE_ABSDIR+"/"+"MaskRCNN"
+# Directory to save logs and trained model
+MODEL_DIR = os.path.join(ROOT_DIR, "logs")
+# Local path to trained weights file
+MODEL_PATH = os.path.join(MODEL_DIR ,"shapes20191113T1842/mask_rcnn_shapes_0030.h5")
+# Directory of images to run detection on
+IMAGE_DIR = os.path.join(ROOT_DIR, "images")
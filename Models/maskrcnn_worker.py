@@ -0,0 +1,322 @@
+"""
+Resident MaskRCNN inference worker.
+The MaskGenerator is loaded only once in a long-lived process and the flask server sends
+the images to it through a pipe. TensorFlow never runs inside the flask process, so the
+GPU/CPU memory of the model is released by the OS whenever the worker exits, which is the
+reason why the start_detector action was abandoned before.
+Frames of the default size(480x640) and their masks are passed through a SharedFrameRing
+(Utils/shared_frame_ring.py) instead of being pickled, only the slot index goes through the pipe.
+Micro-batching: every request carries an id, so many requests(threads of the flask server,
+several cells or cameras) can be in flight at the same time. The worker collects up to
+batch_size of them within batch_window seconds, runs them through one model.detect call and
+sends every result back to its own request.
+If the worker crashes (or hangs longer than detect_timeout), it is killed and restarted on
+the next request automatically.
+EX:
+worker=MaskRCNNWorker(['BG', 'apple','banana','box','cup','tape'],batch_size=4)
+worker.start()                       # optional, otherwise it starts on the first request
+mask=worker.generate_mask('cup',image)     # CompactMask, mask.count / mask.to_dense()
+instances=worker.generate_masks(['cup','tape'],image)   # one forward pass for several labels
+worker.stop()
+"""
+import atexit
+import itertools
+import multiprocessing
+import threading
+import time
+import traceback
+from concurrent.futures import Future,TimeoutError as FutureTimeoutError
+import numpy as np
+from Utils.compact_mask import CompactMask
+from Utils.shared_frame_ring import SharedFrameRing
+
+# ===============================================================
+# code running inside the worker process
+# ===============================================================
+def _worker_main(conn,class_names,ring_spec,batch_size=1,batch_window=0.0):
+    try:
+        # import here so that TensorFlow is only loaded in the worker process
+        from Models.maskrcnn_mask_generator import MaskGenerator
+        generator=MaskGenerator(class_names,batch_size)
+        generator.load_model()
+        ring=SharedFrameRing.attach(*ring_spec)
+    except Exception:
+        conn.send((None,'error',traceback.format_exc()))
+        conn.close()
+        return
+    conn.send((None,'ready',None))
+    running=True
+    while running:
+        try:
+            requests=[conn.recv()]
+            # wait a little for more requests, so they share one model.detect call
+            deadline=time.time()+batch_window
+            while len(requests)<batch_size:
+                remain=deadline-time.time()
+                if remain<=0 or not conn.poll(remain):
+                    break
+                requests.append(conn.recv())
+        except (EOFError,OSError):
+            break
+        if any(command=='stop' for request_id,command,payload in requests):
+            running=False
+            requests=[request for request in requests if request[1]!='stop']
+        if requests:
+            _run_batch(conn,generator,ring,requests)
+    ring.close()
+    conn.close()
+# run every request of the batch with one detect_batch and reply one by one
+def _run_batch(conn,generator,ring,requests):
+    images=[]
+    jobs=[]
+    for request_id,command,payload in requests:
+        try:
+            if command=='mask':
+                label,image=payload
+            elif command=='mask_slot':
+                # the slot belongs to this process until we reply
+                label,slot=payload
+                image=ring.image_view(slot)
+            elif command=='masks':
+                labels,image,min_score,top_k=payload
+            elif command=='masks_slot':
+                labels,slot,min_score,top_k=payload
+                image=ring.image_view(slot)
+            else:
+                raise Exception("Unknown command for the MaskRCNN worker: %s" % command)
+        except Exception:
+            conn.send((request_id,'error',traceback.format_exc()))
+            continue
+        images.append(image)
+        jobs.append((request_id,command,payload))
+    if not jobs:
+        return
+    try:
+        results=generator.detect_batch(images)
+    except Exception:
+        error=traceback.format_exc()
+        for request_id,command,payload in jobs:
+            conn.send((request_id,'error',error))
+        return
+    for (request_id,command,payload),r in zip(jobs,results):
+        try:
+            if command=='mask':
+                result=generator.first_mask(r,payload[0])
+            elif command=='mask_slot':
+                label,slot=payload
+                mask=generator.first_mask(r,label)
+                result=mask is not None
+                if result:
+                    ring.mask_view(slot)[:]=mask
+            else:
+                labels=payload[0]
+                min_score,top_k=payload[2:4]
+                result=_compact_instances(generator.collect_instances(r,labels,min_score,top_k))
+            conn.send((request_id,'ok',result))
+        except Exception:
+            conn.send((request_id,'error',traceback.format_exc()))
+# pack the masks before they are pickled through the pipe
+def _compact_instances(instances):
+    for label in instances:
+        for instance in instances[label]:
+            instance['mask']=CompactMask.from_dense(instance['mask'])
+    return instances
+
+# ===============================================================
+# client used by the flask server
+# ===============================================================
+"""
+Pipe to one worker process and the requests waiting for its answers
+A reader thread hands every reply to the Future of its request id. If the worker exits,
+all waiting requests fail with EOFError, so they can be sent again to a new worker.
+"""
+class _WorkerConnection():
+    def __init__(self,conn):
+        self.conn=conn
+        self.closed=False
+        self._pending={}
+        self._ids=itertools.count()
+        self._lock=threading.Lock()
+        # sending is not under _lock, so the reader thread never waits for a big send
+        self._send_lock=threading.Lock()
+        self._reader=threading.Thread(target=self._read_loop,name="maskrcnn-worker-reader",daemon=True)
+        self._reader.start()
+    def submit(self,command,payload):
+        future=Future()
+        with self._lock:
+            if self.closed:
+                raise EOFError("MaskRCNN worker exited.")
+            request_id=next(self._ids)
+            self._pending[request_id]=future
+        try:
+            with self._send_lock:
+                self.conn.send((request_id,command,payload))
+        except (EOFError,OSError):
+            with self._lock:
+                self._pending.pop(request_id,None)
+            raise
+        return future
+    def send_stop(self):
+        with self._send_lock:
+            self.conn.send((None,'stop',None))
+    # call it after the process exited, the reader thread stops at EOF
+    def close(self):
+        self._reader.join(5)
+        self.conn.close()
+    def _read_loop(self):
+        while True:
+            try:
+                request_id,status,result=self.conn.recv()
+            except (EOFError,OSError):
+                break
+            with self._lock:
+                future=self._pending.pop(request_id,None)
+            if future is not None:
+                future.set_result((status,result))
+        with self._lock:
+            self.closed=True
+            futures=list(self._pending.values())
+            self._pending.clear()
+        for future in futures:
+            future.set_exception(EOFError("MaskRCNN worker exited."))
+
+class MaskRCNNWorker():
+    def __init__(self,class_names,start_timeout=300,detect_timeout=60,ring_slots=4,frame_shape=(480,640),
+                 batch_size=1,batch_window=0.01):
+        self.class_names=list(class_names)
+        self.batch_size=batch_size
+        self.batch_window=batch_window
+        # a full batch needs one slot per request
+        self.ring_slots=max(ring_slots,batch_size)
+        self.frame_shape=frame_shape
+        self._ring=None
+        self.start_timeout=start_timeout
+        self.detect_timeout=detect_timeout
+        # spawn: the child must not inherit the state of the flask process
+        self._context=multiprocessing.get_context('spawn')
+        self._process=None
+        self._connection=None
+        self._lock=threading.Lock()
+        self._ring_lock=threading.Lock()
+        atexit.register(self.shutdown)
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+    # alive and its pipe is still open(the reader thread may see EOF before the process is reaped)
+    def _is_healthy(self):
+        return self.is_alive() and not self._connection.closed
+    def start(self):
+        with self._lock:
+            self._start()
+    def stop(self):
+        with self._lock:
+            self._stop()
+    # stop the worker and free the shared memory, called at exit
+    def shutdown(self):
+        self.stop()
+        if self._ring is not None:
+            self._ring.close()
+            self._ring=None
+    """
+    Same as MaskGenerator.generateMask but running in the worker process
+    return the CompactMask of the first instance of label or None
+    """
+    def generate_mask(self,label,image):
+        image=np.asarray(image)
+        ring=self._get_ring()
+        if not ring.fits(image):
+            mask=self._request('mask',(label,image))
+            return None if mask is None else CompactMask.from_dense(mask)
+        # copying into the slot happens before sending,
+        # so it overlaps with the detection of the other requests
+        slot=ring.acquire()
+        try:
+            np.copyto(ring.image_view(slot),image)
+            found=self._request('mask_slot',(label,slot))
+            # pack straight from the shared memory, the full frame is never copied
+            return CompactMask.from_dense(ring.mask_view(slot)) if found else None
+        finally:
+            ring.release(slot)
+    """
+    Same as MaskGenerator.generateMasks: all instances of every label in labels
+    from a single forward pass, {label: [{'score','bbox','mask'},...]}, mask is a CompactMask
+    """
+    def generate_masks(self,labels,image,min_score=0.0,top_k=None):
+        image=np.asarray(image)
+        ring=self._get_ring()
+        if not ring.fits(image):
+            return self._request('masks',(list(labels),image,min_score,top_k))
+        slot=ring.acquire()
+        try:
+            np.copyto(ring.image_view(slot),image)
+            return self._request('masks_slot',(list(labels),slot,min_score,top_k))
+        finally:
+            ring.release(slot)
+    def _get_ring(self):
+        if self._ring is None:
+            with self._ring_lock:
+                if self._ring is None:
+                    self._ring=SharedFrameRing(self.ring_slots,self.frame_shape[0],self.frame_shape[1])
+        return self._ring
+    def _request(self,command,payload):
+        # one retry with a fresh worker if the old one died
+        for retry in range(2):
+            try:
+                with self._lock:
+                    if not self._is_healthy():
+                        self._start()
+                    connection=self._connection
+                future=connection.submit(command,payload)
+                status,result=future.result(self.detect_timeout)
+            except FutureTimeoutError:
+                with self._lock:
+                    if self._connection is connection:
+                        self._stop(kill=True)
+                raise Exception("MaskRCNN worker did not answer in %d seconds." % self.detect_timeout)
+            except (EOFError,OSError):
+                print("MaskRCNN worker crashed, restart it!!!")
+                if retry==1:
+                    raise
+                continue
+            if status=='error':
+                raise Exception("MaskRCNN worker failed:\n"+result)
+            return result
+    def _start(self):
+        if self._is_healthy():
+            return
+        self._stop(kill=True)
+        parent_conn,child_conn=self._context.Pipe()
+        process=self._context.Process(target=_worker_main,
+                                      args=(child_conn,self.class_names,self._get_ring().spec(),self.batch_size,self.batch_window),
+                                      daemon=True)
+        process.start()
+        child_conn.close()
+        if not parent_conn.poll(self.start_timeout):
+            process.terminate()
+            raise Exception("MaskRCNN worker could not load the model in %d seconds." % self.start_timeout)
+        try:
+            request_id,status,result=parent_conn.recv()
+        except EOFError:
+            process.join()
+            raise Exception("MaskRCNN worker exited while loading the model (exit code %s)." % process.exitcode)
+        if status!='ready':
+            process.join()
+            raise Exception("MaskRCNN worker could not load the model:\n"+str(result))
+        self._process=process
+        self._connection=_WorkerConnection(parent_conn)
+        print("MaskRCNN worker is ready, pid: %d, batch size: %d" % (process.pid,self.batch_size))
+    def _stop(self,kill=False):
+        if self._process is None:
+            return
+        if not kill and self._process.is_alive():
+            try:
+                self._connection.send_stop()
+            except (EOFError,OSError):
+                pass
+            self._process.join(10)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        # the reader thread gets EOF from the dead process and fails the waiting requests
+        self._connection.close()
+        self._process=None
+        self._connection=None
@@ -0,0 +1,240 @@
+"""
+Registry of the actions which LabVIEW triggers through /todo/api/v1.0/actions/...
+Instead of one long if/elif chain, every action is a function registered with the mode it
+runs in and how many of it may run at the same time:
+mode='inline' : run in the request thread (cheap actions, ex: check_image_number, sayhi)
+mode='thread' : run on the thread pool of its group (camera, detection, file io)
+mode='process': run on a process pool, the handler and its parameter must be picklable
+limit: max number of running calls of the group, ex: limit=1 -> one capture at a time
+group: actions with the same group share the limit, default is the action name
+A call can be synchronous (dispatch) or submitted as a job (submit) and polled by job id,
+so a long detection never blocks the polling of another action.
+Handlers return a dict which can be sent back with jsonify.
+Inside a job, a handler can call report_stage('captured') etc. Every job keeps the list of its
+stage events(running, the reported stages, then done/failed), which can be waited for with
+wait(job_id,stage=...) or streamed with iter_events(job_id).
+EX:
+router=ActionRouter()
+@router.action('get_photo_and_mask',mode='thread',limit=1,group='camera',parameter=True)
+def get_photo_and_mask(target_label):
+    return {'msg': "Successfully detect mask"}
+router.dispatch('get_photo_and_mask','cup')        # wait for the result
+job_id=router.submit('get_photo_and_mask','cup')   # return at once
+router.job(job_id)                                 # {'state': 'running', ...}
+router.wait(job_id,timeout=5,stage='captured')     # long-poll until the frame is taken
+"""
+import itertools
+import multiprocessing
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
+
+ACTION_MODES=('inline','thread','process')
+JOB_FINISHED=('done','failed')
+# job which is running in the current thread, set by ActionRouter._run_job
+_current=threading.local()
+"""
+Report a stage of the running job, ex: report_stage('masked',pixels=mask.count)
+data must be jsonable. Does nothing if the action is not running as a job (dispatch or process mode).
+"""
+def report_stage(stage,**data):
+    job=getattr(_current,'job',None)
+    if job is not None:
+        _current.router._add_event(job,stage,data)
+
+class _Action():
+    def __init__(self,name,handler,mode,group,parameter):
+        self.name=name
+        self.handler=handler
+        self.mode=mode
+        self.group=group
+        self.parameter=parameter
+
+class _Group():
+    def __init__(self,name,limit,max_workers):
+        self.name=name
+        self.limit=limit
+        # inline calls and jobs of the group share the semaphore
+        self.semaphore=threading.BoundedSemaphore(limit) if limit else None
+        self.executor=ThreadPoolExecutor(max_workers=limit or max_workers,thread_name_prefix="action-"+name)
+
+class ActionRouter():
+    def __init__(self,max_workers=4,max_processes=2,max_jobs=256):
+        self.max_workers=max_workers
+        self.max_processes=max_processes
+        self.max_jobs=max_jobs
+        self._actions={}
+        self._groups={}
+        self._jobs=OrderedDict()
+        self._job_ids=itertools.count(1)
+        self._lock=threading.Lock()
+        # notified whenever a job gets a new event
+        self._changed=threading.Condition(self._lock)
+        self._process_pool=None
+    # decorator version of register
+    def action(self,name,mode='inline',limit=None,group=None,parameter=False):
+        def decorator(handler):
+            self.register(name,handler,mode,limit,group,parameter)
+            return handler
+        return decorator
+    """
+    parameter=True: the action is called as handler(action_parameter)
+    (the /actions/<action_name>/<action_parameter> route), otherwise handler()
+    """
+    def register(self,name,handler,mode='inline',limit=None,group=None,parameter=False):
+        if mode not in ACTION_MODES:
+            raise Exception("Unknown action mode: %s" % mode)
+        group=group or name
+        with self._lock:
+            if group not in self._groups:
+                self._groups[group]=_Group(group,limit,self.max_workers)
+            elif limit is not None and self._groups[group].limit!=limit:
+                raise Exception("Action group %s already has the limit %s." % (group,self._groups[group].limit))
+            self._actions[(name,parameter)]=_Action(name,handler,mode,group,parameter)
+    def has_action(self,name,parameter=False):
+        return (name,parameter) in self._actions
+    # run the action and wait for its result
+    def dispatch(self,name,parameter=None):
+        action=self._get_action(name,parameter)
+        if action.mode=='inline':
+            return self._run(action,parameter)
+        return self._groups[action.group].executor.submit(self._run,action,parameter).result()
+    # run the action in the background, return the job id at once
+    def submit(self,name,parameter=None):
+        action=self._get_action(name,parameter)
+        job={
+            'id':str(next(self._job_ids)),
+            'action':name,
+            'parameter':parameter,
+            'state':'queued',
+            'result':None,
+            'error':None,
+            'submitted':time.time(),
+            'started':None,
+            'finished':None,
+            'stage':'queued',
+            'events':[]
+        }
+        with self._lock:
+            self._jobs[job['id']]=job
+            self._forget_old_jobs()
+        self._groups[action.group].executor.submit(self._run_job,job,action,parameter)
+        return job['id']
+    # copy of the job state, None if the job id is unknown(or forgotten)
+    def job(self,job_id):
+        with self._lock:
+            return self._copy_job(self._jobs.get(job_id))
+    """
+    Long-poll: wait until the job is finished, or until it reached stage if stage is given
+    return the copy of the job(also after timeout), None if the job id is unknown
+    """
+    def wait(self,job_id,timeout=None,stage=None):
+        deadline=None if timeout is None else time.time()+timeout
+        with self._changed:
+            while True:
+                job=self._jobs.get(job_id)
+                if job is None or job['state'] in JOB_FINISHED:
+                    break
+                if stage is not None and any(event['stage']==stage for event in job['events']):
+                    break
+                remain=None if deadline is None else deadline-time.time()
+                if remain is not None and remain<=0:
+                    break
+                self._changed.wait(remain)
+            return self._copy_job(job)
+    """
+    Generator of the stage events of a job, from the first one, until done/failed
+    It stops early if no new event arrives in timeout seconds.
+    """
+    def iter_events(self,job_id,timeout=60):
+        index=0
+        while True:
+            deadline=time.time()+timeout
+            with self._changed:
+                job=self._jobs.get(job_id)
+                if job is None:
+                    return
+                # the condition is shared by all jobs, so wait until this one changed
+                while index>=len(job['events']) and job['state'] not in JOB_FINISHED:
+                    remain=deadline-time.time()
+                    if remain<=0:
+                        return
+                    self._changed.wait(remain)
+                events=job['events'][index:]
+            for event in events:
+                yield event
+                if event['stage'] in JOB_FINISHED:
+                    return
+            index+=len(events)
+    def shutdown(self):
+        for group in self._groups.values():
+            group.executor.shutdown(wait=False)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+    def _get_action(self,name,parameter):
+        action=self._actions.get((name,parameter is not None))
+        if action is None:
+            raise KeyError("Unknown action: %s" % name)
+        return action
+    def _run(self,action,parameter):
+        args=(parameter,) if action.parameter else ()
+        semaphore=self._groups[action.group].semaphore
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            if action.mode=='process':
+                return self._get_process_pool().submit(action.handler,*args).result()
+            return action.handler(*args)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+    def _run_job(self,job,action,parameter):
+        self._add_event(job,'running',{})
+        _current.job=job
+        _current.router=self
+        try:
+            result=self._run(action,parameter)
+        except Exception:
+            error=traceback.format_exc()
+            print(error)
+            self._add_event(job,'failed',{'error':error},error=error)
+            return
+        finally:
+            _current.job=None
+        self._add_event(job,'done',result,result=result)
+    # running/done/failed also set the state(and the result/error) of the job in the same lock
+    def _add_event(self,job,stage,data,**finished):
+        with self._changed:
+            now=time.time()
+            if stage=='running':
+                job['state']=stage
+                job['started']=now
+            elif stage in JOB_FINISHED:
+                job.update(finished)
+                job['state']=stage
+                job['finished']=now
+            job['stage']=stage
+            job['events'].append({'stage':stage,'time':now,'data':data})
+            self._changed.notify_all()
+    def _copy_job(self,job):
+        if job is None:
+            return None
+        job=dict(job)
+        job['events']=list(job['events'])
+        return job
+    def _get_process_pool(self):
+        with self._lock:
+            if self._process_pool is None:
+                # spawn: the children must not inherit the flask/TensorFlow state
+                self._process_pool=ProcessPoolExecutor(self.max_processes,mp_context=multiprocessing.get_context('spawn'))
+            return self._process_pool
+    # keep at most max_jobs jobs, the oldest finished ones are forgotten first
+    def _forget_old_jobs(self):
+        if len(self._jobs)<=self.max_jobs:
+            return
+        for job_id in [job_id for job_id,job in self._jobs.items() if job['state'] in JOB_FINISHED]:
+            del self._jobs[job_id]
+            if len(self._jobs)<=self.max_jobs:
+                break
@@ -0,0 +1,57 @@
+"""
+Compact mask of one instance
+MaskRCNN masks are mostly background, so only the bounding box of the set pixels is kept,
+bit-packed (1 bit per pixel). A 640x480 mask of a cup is a few KB instead of 2.4MB(int64).
+The pixel count is computed once, and the (v,u) of the set pixels are decoded from the box
+only, so the back-projection never builds the full frame.
+EX:
+mask=CompactMask.from_dense(dense_mask)
+mask.count                  # number of set pixels
+v,u=mask.nonzero()          # same order as np.nonzero(dense_mask) (row-major)
+dense=mask.to_dense()       # (H,W) uint8 0/1, only when really needed(ex: saving a png)
+"""
+import numpy as np
+
+class CompactMask():
+    def __init__(self,shape,bbox,bits,count):
+        # shape: (H,W) of the full frame, bbox: (y1,x1,y2,x2) with y2,x2 exclusive
+        self.shape=(int(shape[0]),int(shape[1]))
+        self.bbox=tuple(int(value) for value in bbox)
+        self.bits=bits
+        self.count=int(count)
+    @classmethod
+    def from_dense(cls,mask):
+        mask=np.asarray(mask)
+        if mask.ndim!=2:
+            raise Exception("Mask should be a (H,W) array.")
+        rows=np.flatnonzero(mask.any(axis=1))
+        if len(rows)==0:
+            return cls(mask.shape,(0,0,0,0),np.empty(0,dtype=np.uint8),0)
+        cols=np.flatnonzero(mask.any(axis=0))
+        y1,y2,x1,x2=rows[0],rows[-1]+1,cols[0],cols[-1]+1
+        crop=mask[y1:y2,x1:x2]!=0
+        return cls(mask.shape,(y1,x1,y2,x2),np.packbits(crop),np.count_nonzero(crop))
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+    # (h,w) bool array of the bounding box
+    def crop(self):
+        y1,x1,y2,x2=self.bbox
+        size=(y2-y1)*(x2-x1)
+        # unpackbits(count=) needs numpy>=1.17, the padding bits of the last byte are cut off here
+        return np.unpackbits(self.bits)[:size].reshape(y2-y1,x2-x1).view(np.bool_)
+    # (v,u) of the set pixels in the full frame, row-major like np.nonzero
+    def nonzero(self):
+        v,u=np.nonzero(self.crop())
+        return v+self.bbox[0],u+self.bbox[1]
+    def to_dense(self):
+        dense=np.zeros(self.shape,dtype=np.uint8)
+        y1,x1,y2,x2=self.bbox
+        dense[y1:y2,x1:x2]=self.crop()
+        return dense
+    # np.asarray(mask) still works for the code which needs a full frame
+    def __array__(self,dtype=None,copy=None):
+        dense=self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+    def __repr__(self):
+        return "CompactMask(shape=%s, bbox=%s, count=%d, %d bytes)" % (self.shape,self.bbox,self.count,self.nbytes)
@@ -0,0 +1,227 @@
+"""
+Pipelined exploration
+Every view goes through three stages, each one running in its own worker thread(s):
+capture -> detect -> fuse
+capture: grab_view(request_time) returns (rgb color, depth, pose) of a frame newer than the request
+detect : detect_mask(image,label) returns the mask(CompactMask/nparray) or None
+fuse   : back-project the masked pixels and transform them to the base frame,
+         the view is added to the running cloud right away
+         (or integrated into a VoxelHashAccumulator, then the cloud stays deduplicated)
+         (or integrated into a MaskedTSDFVolume, then the cloud is the fused surface)
+While view k is detected, view k+1 can already be captured and view k-1 fused, so a cycle
+takes about as long as the slowest stage instead of the sum of all stages, and the fused
+cloud is ready almost the moment the last mask arrives.
+EX:
+pipeline=ExplorationPipeline(grab_view,detect_mask,REALSENSE_CAMERA,accumulator=VoxelHashAccumulator(0.001))
+pipeline.start()
+view=pipeline.request_view('cup')
+view.wait('captured')           # the arm can move to the next viewpoint now
+xyz,rgb=pipeline.finish()       # wait for every requested view, then the fused cloud
+pipeline.reset()                # next exploration
+"""
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+from Utils.point_cloud_tool import backproject_masked_rgbd
+from Utils.metrics import span
+
+# stages of a view in order, no_mask and failed end a view too
+VIEW_STAGES=('queued','captured','masked','fused')
+VIEW_FINISHED=('fused','no_mask','failed')
+
+class ExplorationView():
+    def __init__(self,index,label,request_time,cond):
+        self.index=index
+        self.label=label
+        self.request_time=request_time
+        self.state='queued'
+        self.error=None
+        # number of points this view added to the cloud
+        self.points=0
+        self._cond=cond
+        # filled by the stages, released after fusion
+        self.color=None
+        self.depth=None
+        self.pose=None
+        self.mask=None
+    def finished(self):
+        return self.state in VIEW_FINISHED
+    def reached(self,stage):
+        return self.finished() or VIEW_STAGES.index(self.state)>=VIEW_STAGES.index(stage)
+    # block until the view reached stage(or ended), return False after timeout
+    def wait(self,stage='fused',timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.reached(stage),timeout)
+    # block until the view is fused/no_mask/failed(one of VIEW_FINISHED)
+    def wait_finished(self,timeout=None):
+        with self._cond:
+            return self._cond.wait_for(self.finished,timeout)
+    def summary(self):
+        return {
+            'index':self.index,
+            'label':self.label,
+            'state':self.state,
+            'points':self.points,
+            'error':self.error
+        }
+
+class ExplorationPipeline():
+    def __init__(self,grab_view,detect_mask,camera,detect_workers=2,accumulator=None,volume=None):
+        self.grab_view=grab_view
+        self.detect_mask=detect_mask
+        self.camera=camera
+        self.detect_workers=detect_workers
+        self.accumulator=accumulator
+        self.volume=volume
+        self._cond=threading.Condition()
+        self._capture_queue=queue.Queue()
+        self._detect_queue=queue.Queue()
+        self._fuse_queue=queue.Queue()
+        self._threads=[]
+        # start/stop can be called by concurrent requests(explore_view has no limit)
+        self._threads_lock=threading.Lock()
+        self._views=[]
+        # fused points of every view, concatenated only when the cloud is asked for
+        self._xyz_chunks=[]
+        self._rgb_chunks=[]
+    def start(self):
+        with self._threads_lock:
+            if self._threads:
+                return
+            workers=[('capture',self._capture_loop)]
+            workers+=[('detect-%d' % i,self._detect_loop) for i in range(self.detect_workers)]
+            workers+=[('fuse',self._fuse_loop)]
+            for name,target in workers:
+                thread=threading.Thread(target=target,name="exploration-"+name,daemon=True)
+                thread.start()
+                self._threads.append(thread)
+    def stop(self):
+        with self._threads_lock:
+            if not self._threads:
+                return
+            self._capture_queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads=[]
+    # put a view into the capture stage, return at once
+    def request_view(self,label,request_time=None):
+        if not self._threads:
+            raise Exception("The exploration pipeline is not started.")
+        with self._cond:
+            view=ExplorationView(len(self._views),label,request_time or time.time(),self._cond)
+            self._views.append(view)
+        self._capture_queue.put(view)
+        return view
+    def views(self):
+        with self._cond:
+            return list(self._views)
+    """
+    Wait until every requested view ended, then return the fused cloud
+    return: xyz (N,3) float32 in base frame, rgb (N,3) uint8
+    """
+    def finish(self,timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: all(view.finished() for view in self._views),timeout):
+                raise Exception("The exploration views are not finished in %s seconds." % timeout)
+        return self.snapshot()
+    # fused cloud of the views which are fused so far
+    def snapshot(self):
+        if self.volume is not None:
+            with self._cond:
+                return self.volume.extract_points()
+        if self.accumulator is not None:
+            return self.accumulator.snapshot()
+        with self._cond:
+            xyz_chunks=list(self._xyz_chunks)
+            rgb_chunks=list(self._rgb_chunks)
+        if not xyz_chunks:
+            return np.empty((0,3),dtype=np.float32),np.empty((0,3),dtype=np.uint8)
+        return np.concatenate(xyz_chunks),np.concatenate(rgb_chunks)
+    # forget the views and the cloud, views which are still running are kept
+    def reset(self):
+        with self._cond:
+            self._views=[view for view in self._views if not view.finished()]
+            self._xyz_chunks=[]
+            self._rgb_chunks=[]
+            if self.accumulator is not None:
+                self.accumulator.clear()
+            if self.volume is not None:
+                self.volume.clear()
+    def _set_state(self,view,state,error=None):
+        with self._cond:
+            view.state=state
+            view.error=error
+            if view.finished():
+                view.color=view.depth=view.mask=None
+            self._cond.notify_all()
+    def _fail(self,view):
+        error=traceback.format_exc()
+        print(error)
+        self._set_state(view,'failed',error)
+    # the None sentinel goes through all stages, so every queue is drained before stopping
+    def _capture_loop(self):
+        while True:
+            view=self._capture_queue.get()
+            if view is None:
+                for i in range(self.detect_workers):
+                    self._detect_queue.put(None)
+                return
+            try:
+                view.color,view.depth,view.pose=self.grab_view(view.request_time)
+            except Exception:
+                self._fail(view)
+                continue
+            self._set_state(view,'captured')
+            self._detect_queue.put(view)
+    def _detect_loop(self):
+        while True:
+            view=self._detect_queue.get()
+            if view is None:
+                self._fuse_queue.put(None)
+                return
+            try:
+                view.mask=self.detect_mask(view.color,view.label)
+            except Exception:
+                self._fail(view)
+                continue
+            if view.mask is None:
+                self._set_state(view,'no_mask')
+                continue
+            self._set_state(view,'masked')
+            self._fuse_queue.put(view)
+    def _fuse_loop(self):
+        stopped=0
+        while stopped<self.detect_workers:
+            view=self._fuse_queue.get()
+            if view is None:
+                stopped+=1
+                continue
+            try:
+                with span('fuse'):
+                    self._fuse(view)
+            except Exception:
+                self._fail(view)
+                continue
+            self._set_state(view,'fused')
+    # back-project(or integrate) one view, in base frame
+    def _fuse(self,view):
+        if view.pose is None:
+            raise Exception("The pose of view %d is missing, send the 6dof before taking photos." % view.index)
+        if self.volume is not None:
+            # the volume is read by snapshot, so it is integrated in the lock
+            with self._cond:
+                view.points=self.volume.integrate(view.color,view.depth,view.mask,view.pose,self.camera)
+            return
+        xyz_points,rgb_points=backproject_masked_rgbd(view.color,view.depth,view.mask,self.camera)
+        # [R|t] 一次乘完整個view
+        pose=np.asarray(view.pose,dtype=np.float32)
+        xyz_points=xyz_points.dot(pose[0:3,0:3].T)+pose[0:3,3]
+        if self.accumulator is not None:
+            view.points=self.accumulator.integrate(xyz_points,rgb_points)
+        else:
+            with self._cond:
+                self._xyz_chunks.append(xyz_points)
+                self._rgb_chunks.append(rgb_points)
+                view.points=len(xyz_points)
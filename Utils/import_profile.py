@@ -0,0 +1,65 @@
+"""
+Import-time profile of the servers
+It imports the module in a fresh interpreter with `python -X importtime` and reports the
+slowest imports, and whether any of the heavy packages(tensorflow, mrcnn, open3d, ...) is
+still imported at startup. Those should only be loaded by the action which needs them.
+Usage (from the root of this repo):
+python Utils/import_profile.py                        # restapi_server_rgbd
+python Utils/import_profile.py restapi_server --top 30
+"""
+import os
+import sys
+import argparse
+import subprocess
+import tempfile
+ROOT_DIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# packages which take seconds to import, none of them should be in the startup path
+HEAVY_PACKAGES=['tensorflow','keras','mrcnn','open3d','pyrealsense2','matplotlib','sklearn','scipy','skimage']
+
+"""
+return: list of (module, self time(s), cumulative time(s), depth) in import order
+"""
+def profile_import(module):
+    env=dict(os.environ)
+    env['PYTHONPATH']=ROOT_DIR+os.pathsep+env.get('PYTHONPATH','')
+    # the servers create their cache folders in the working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        result=subprocess.run([sys.executable,'-X','importtime','-c','import '+module],
+                              cwd=workdir,env=env,stderr=subprocess.PIPE,stdout=subprocess.DEVNULL,
+                              universal_newlines=True)
+    records=[]
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time,cumulative,name=line[len('import time:'):].split('|')
+        depth=(len(name)-len(name.lstrip()))//2
+        records.append((name.strip(),int(self_time)/1e6,int(cumulative)/1e6,depth))
+    if result.returncode!=0:
+        print(result.stderr[-2000:])
+        raise Exception("import %s failed." % module)
+    return records
+
+def report(module,top=20):
+    records=profile_import(module)
+    total=[record for record in records if record[0]==module][-1][2]
+    print("*"*30)
+    print("import %s: %.3f s" % (module,total))
+    print("slowest imports (cumulative):")
+    # depth 1: what the module itself imports
+    direct=sorted([record for record in records if record[3]==1],key=lambda record:-record[2])
+    for name,self_time,cumulative,depth in direct[:top]:
+        print("  %-45s %8.3f s" % (name,cumulative))
+    print("slowest modules (self):")
+    for name,self_time,cumulative,depth in sorted(records,key=lambda record:-record[1])[:top]:
+        print("  %-45s %8.3f s" % (name,self_time))
+    imported=set(record[0].split('.')[0] for record in records)
+    heavy=[package for package in HEAVY_PACKAGES if package in imported]
+    print("heavy packages imported at startup: %s" % (", ".join(heavy) if heavy else "none"))
+    return total,heavy
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser()
+    parser.add_argument('module',nargs='?',default='restapi_server_rgbd')
+    parser.add_argument('--top',type=int,default=15)
+    args=parser.parse_args()
+    report(args.module,args.top)
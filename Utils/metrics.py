@@ -0,0 +1,157 @@
+"""
+In-memory latency metrics of the hot path
+Every stage(capture, align, detect, back_project, fuse, ply_write, json_index) is timed with
+span() and kept in a histogram with fixed buckets, so the memory does not grow with the number
+of requests. The histograms can be read as Prometheus text(/metrics) or as a json summary.
+When METRICS.enabled is False, span() returns a shared object which does nothing, so the
+instrumentation can stay in the hot path.
+EX:
+from Utils.metrics import span,METRICS
+with span('detect'):
+    mask=MASK_WORKER.generate_mask(label,image)
+METRICS.summary()            # {'detect': {'count': 1, 'mean': 0.21, 'p50': ..., ...}}
+METRICS.prometheus_text()    # text of the /metrics route
+"""
+import bisect
+import threading
+import time
+
+# upper bounds in seconds, the +Inf bucket is added by the histogram
+DEFAULT_BUCKETS=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+
+class Histogram():
+    def __init__(self,buckets=DEFAULT_BUCKETS):
+        self.buckets=tuple(buckets)
+        # counts[i]: values in (buckets[i-1],buckets[i]], the last one is +Inf
+        self.counts=[0]*(len(self.buckets)+1)
+        self.count=0
+        self.sum=0.0
+        self.min=None
+        self.max=None
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)]+=1
+        self.count+=1
+        self.sum+=value
+        if self.min is None or value<self.min:
+            self.min=value
+        if self.max is None or value>self.max:
+            self.max=value
+    """
+    Estimated quantile(0~1): linear interpolation inside the bucket, like histogram_quantile
+    of Prometheus, clipped to the observed min/max
+    """
+    def quantile(self,q):
+        if self.count==0:
+            return None
+        rank=q*self.count
+        seen=0
+        for i,count in enumerate(self.counts):
+            if count and seen+count>=rank:
+                low=self.buckets[i-1] if i>0 else 0.0
+                high=self.buckets[i] if i<len(self.buckets) else self.max
+                value=low+(high-low)*(rank-seen)/count
+                return min(max(value,self.min),self.max)
+            seen+=count
+        return self.max
+    def summary(self):
+        if self.count==0:
+            return {'count':0}
+        return {
+            'count':self.count,
+            'total':self.sum,
+            'mean':self.sum/self.count,
+            'min':self.min,
+            'max':self.max,
+            'p50':self.quantile(0.5),
+            'p90':self.quantile(0.9),
+            'p99':self.quantile(0.99)
+        }
+
+class _Span():
+    __slots__=('metrics','name','start')
+    def __init__(self,metrics,name):
+        self.metrics=metrics
+        self.name=name
+    def __enter__(self):
+        self.start=time.perf_counter()
+        return self
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.metrics.observe(self.name,time.perf_counter()-self.start)
+        return False
+
+# returned by span() when the metrics are disabled
+class _NullSpan():
+    __slots__=()
+    def __enter__(self):
+        return self
+    def __exit__(self,exc_type,exc_value,traceback):
+        return False
+_NULL_SPAN=_NullSpan()
+
+class Metrics():
+    def __init__(self,enabled=True,buckets=DEFAULT_BUCKETS,prefix='flaskapi'):
+        self.enabled=enabled
+        self.buckets=tuple(buckets)
+        self.prefix=prefix
+        self._histograms={}
+        self._lock=threading.Lock()
+    # with metrics.span('fuse'): ... (failed calls are timed too)
+    def span(self,name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self,name)
+    def observe(self,name,seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram=self._histograms.get(name)
+            if histogram is None:
+                histogram=self._histograms[name]=Histogram(self.buckets)
+            histogram.observe(seconds)
+    def reset(self):
+        with self._lock:
+            self._histograms={}
+    # {stage: {'count','total','mean','min','max','p50','p90','p99'}} (seconds)
+    def summary(self):
+        with self._lock:
+            return {name:histogram.summary() for name,histogram in sorted(self._histograms.items())}
+    # Prometheus text exposition format(version 0.0.4), one histogram with a stage label
+    def prometheus_text(self):
+        metric=self.prefix+"_stage_duration_seconds"
+        lines=["# HELP %s Latency of the hot path stages in seconds." % metric,
+               "# TYPE %s histogram" % metric]
+        with self._lock:
+            for name,histogram in sorted(self._histograms.items()):
+                cumulative=0
+                for bound,count in zip(histogram.buckets+(None,),histogram.counts):
+                    cumulative+=count
+                    le="+Inf" if bound is None else repr(float(bound))
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' % (metric,name,le,cumulative))
+                lines.append('%s_sum{stage="%s"} %r' % (metric,name,histogram.sum))
+                lines.append('%s_count{stage="%s"} %d' % (metric,name,histogram.count))
+        return "\n".join(lines)+"\n"
+
+# shared by the servers and the Utils modules
+METRICS=Metrics()
+def span(name):
+    return METRICS.span(name)
+
+if __name__=='__main__':
+    for i in range(1000):
+        with span('noop'):
+            pass
+    print(METRICS.summary())
+    print(METRICS.prometheus_text())
+    loops=200000
+    start=time.perf_counter()
+    for i in range(loops):
+        with span('loop'):
+            pass
+    enabled_cost=(time.perf_counter()-start)/loops
+    METRICS.enabled=False
+    start=time.perf_counter()
+    for i in range(loops):
+        with span('loop'):
+            pass
+    disabled_cost=(time.perf_counter()-start)/loops
+    print("span cost: enabled %.2f us, disabled %.2f us" % (enabled_cost*1e6,disabled_cost*1e6))
@@ -0,0 +1,180 @@
+"""
+Benchmark of the point cloud tools on a synthetic 640x480 RealSense frame.
+It compares the per-pixel PIL implementation we used before with the
+numpy engine in point_cloud_tool and checks that both give the same cloud.
+Usage (from the root of this repo):
+python Utils/point_cloud_benchmark.py
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from PIL import Image
+ROOT_DIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from Config.realsense_config import RGBDCamera
+from Utils.point_cloud_tool import mask_to_partial_pointcloud,backproject_masked_rgbd,fuse_masked_views
+from Utils.point_cloud_tool import points_to_ply_lines,savePoints_to_ply,save_pointcloud_to_ply,PlyPointCloud
+from Utils.point_cloud_tool import calc_distances,furthest_point_sampling,furthest_point_sampling_batch
+
+WIDTH=640
+HEIGHT=480
+# ====================================================
+# synthetic frame
+# ====================================================
+def make_frame(width=WIDTH,height=HEIGHT,seed=0):
+    rng=np.random.RandomState(seed)
+    color=rng.randint(0,256,(height,width,3)).astype(np.uint8)
+    depth=rng.randint(300,1500,(height,width)).astype(np.uint16)
+    # some holes like a real depth map
+    depth[rng.rand(height,width)<0.05]=0
+    v,u=np.mgrid[0:height,0:width]
+    mask=((((u-width/2)/150.0)**2+((v-height/2)/100.0)**2)<=1).astype(np.uint8)
+    return color,depth,mask
+# ====================================================
+# the per-pixel implementation before the numpy engine
+# ====================================================
+def legacy_mask_to_partial_pointcloud(color,depth,mask,camera):
+    color_img = Image.fromarray(color.astype('uint8'), 'RGB')
+    depth_img = Image.fromarray(depth)
+    mask_img = Image.fromarray(mask)
+    points = []
+    xyz_points=[]
+    for v in range(color_img.size[1]):
+        for u in range(color_img.size[0]):
+            color = color_img.getpixel((u,v))
+            Z = depth_img.getpixel((u,v)) * camera.scalingfactor
+            if Z==0 or mask_img.getpixel((u,v))==0: continue
+            X = (u - camera.cx) * Z / camera.fx
+            Y = (v - camera.cy) * Z / camera.fy
+            xyz_points.append([X,Y,Z])
+            points.append("%f %f %f %d %d %d 0\n"%(X,Y,Z,color[0],color[1],color[2]))
+    return points,np.array(xyz_points)
+
+def legacy_join_map_with_mask(pose_list,color_list,depth_list,mask_list,camera):
+    xyz_points=[]
+    for i in range(len(pose_list)):
+        rgb = Image.fromarray(color_list[i], 'RGB')
+        depth = Image.fromarray(depth_list[i])
+        mask = Image.fromarray(mask_list[i])
+        for v in range(rgb.size[1]):
+            for u in range(rgb.size[0]):
+                Z = depth.getpixel((u,v)) * camera.scalingfactor
+                if Z==0 or mask.getpixel((u,v))==0: continue
+                X = (u - camera.cx) * Z / camera.fx
+                Y = (v - camera.cy) * Z / camera.fy
+                world_point=pose_list[i].dot(np.array([X,Y,Z,1]))
+                xyz_points.append([world_point[0],world_point[1],world_point[2]])
+    return np.array(xyz_points)
+
+def make_pose(angle,offset):
+    pose=np.eye(4)
+    pose[0:3,0:3]=[[np.cos(angle),-np.sin(angle),0],[np.sin(angle),np.cos(angle),0],[0,0,1]]
+    pose[0:3,3]=offset
+    return pose
+
+def timeit(func,*args,repeat=1):
+    best=None
+    for _ in range(repeat):
+        start=time.perf_counter()
+        result=func(*args)
+        cost=time.perf_counter()-start
+        best=cost if best is None else min(best,cost)
+    return result,best
+
+def benchmark_backprojection(camera):
+    color,depth,mask=make_frame()
+    (legacy_points,legacy_xyz),legacy_cost=timeit(legacy_mask_to_partial_pointcloud,color,depth,mask,camera)
+    (xyz,rgb),engine_cost=timeit(backproject_masked_rgbd,color,depth,mask,camera,repeat=10)
+    (points,_),wrapper_cost=timeit(mask_to_partial_pointcloud,color,depth,mask,camera,repeat=3)
+    v,u=np.nonzero((depth!=0)&(mask!=0))
+    assert xyz.shape==legacy_xyz.shape
+    assert np.allclose(xyz,legacy_xyz,rtol=1e-6,atol=1e-6)
+    assert np.array_equal(rgb,color[v,u])
+    assert len(points)==len(legacy_points)
+    print("*"*30)
+    print("back-projection of %d points" % xyz.shape[0])
+    print("legacy per-pixel : %.4f s" % legacy_cost)
+    print("numpy engine     : %.4f s (x%.1f)" % (engine_cost,legacy_cost/engine_cost))
+    print("with ply strings : %.4f s (x%.1f)" % (wrapper_cost,legacy_cost/wrapper_cost))
+
+def benchmark_fusion(camera,num_views=5):
+    pose_list,color_list,depth_list,mask_list=[],[],[],[]
+    for i in range(num_views):
+        color,depth,mask=make_frame(seed=i)
+        pose_list.append(make_pose(0.3*i,[0.4,0.05*i,0.2]))
+        color_list.append(color)
+        depth_list.append(depth)
+        mask_list.append(mask)
+    legacy_xyz,legacy_cost=timeit(legacy_join_map_with_mask,pose_list,color_list,depth_list,mask_list,camera)
+    (xyz,rgb),fusion_cost=timeit(fuse_masked_views,pose_list,color_list,depth_list,mask_list,camera,repeat=5)
+    assert xyz.shape==legacy_xyz.shape
+    assert np.allclose(xyz,legacy_xyz,rtol=1e-5,atol=1e-5)
+    print("*"*30)
+    print("fusion of %d views, %d points" % (num_views,xyz.shape[0]))
+    print("legacy per-pixel : %.4f s" % legacy_cost)
+    print("batched fusion   : %.4f s (x%.1f)" % (fusion_cost,legacy_cost/fusion_cost))
+
+def benchmark_ply_writer(num_points=1000000):
+    rng=np.random.RandomState(0)
+    xyz=rng.rand(num_points,3).astype(np.float32)
+    rgb=rng.randint(0,256,(num_points,3)).astype(np.uint8)
+    dirname=tempfile.mkdtemp()
+    def legacy_write():
+        savePoints_to_ply(dirname,"legacy.ply",points_to_ply_lines(xyz,rgb))
+    _,legacy_cost=timeit(legacy_write)
+    _,ascii_cost=timeit(save_pointcloud_to_ply,dirname,"ascii.ply",xyz,rgb,'ascii')
+    _,binary_cost=timeit(save_pointcloud_to_ply,dirname,"binary.ply",xyz,rgb,repeat=3)
+    print("*"*30)
+    print("ply writer with %d points" % num_points)
+    for name,cost in (("legacy.ply",legacy_cost),("ascii.ply",ascii_cost),("binary.ply",binary_cost)):
+        size=os.path.getsize(os.path.join(dirname,name))/1024.0/1024.0
+        print("%-10s : %.4f s, %.1f MB" % (name,cost,size))
+    # reading back: ascii has to be parsed, binary is memory-mapped
+    def read_xyz(name):
+        return np.asarray(PlyPointCloud(os.path.join(dirname,name)).xyz).sum()
+    _,ascii_read_cost=timeit(read_xyz,"ascii.ply")
+    _,binary_read_cost=timeit(read_xyz,"binary.ply",repeat=3)
+    print("read ascii.ply  : %.4f s" % ascii_read_cost)
+    print("read binary.ply : %.4f s (mmap)" % binary_read_cost)
+
+# the fps before the float32 in-place engine
+def legacy_furthest_point_sampling(pts,K,seed_index):
+    N,C=pts.shape
+    farthest_pts = np.zeros((K, C))
+    farthest_pts[0] = pts[seed_index]
+    distances = calc_distances(farthest_pts[0], pts)
+    for i in range(1, K):
+        farthest_pts[i] = pts[np.argmax(distances)]
+        distances = np.minimum(distances, calc_distances(farthest_pts[i], pts))
+    return farthest_pts
+
+def benchmark_furthest_point_sampling(num_points=20000,num_samples=1024,batch_size=16):
+    rng=np.random.RandomState(0)
+    clouds=rng.rand(batch_size,num_points,3).astype(np.float32)
+    legacy,legacy_cost=timeit(legacy_furthest_point_sampling,clouds[0],num_samples,0)
+    sampled,engine_cost=timeit(furthest_point_sampling,clouds[0],num_samples,0,repeat=3)
+    assert np.allclose(sampled,legacy)
+    def legacy_batch():
+        return [legacy_furthest_point_sampling(cloud,num_samples,0) for cloud in clouds]
+    _,legacy_batch_cost=timeit(legacy_batch)
+    indices,batch_cost=timeit(furthest_point_sampling_batch,clouds,num_samples,0,repeat=3)
+    assert np.allclose(clouds[-1][indices[-1]],legacy_furthest_point_sampling(clouds[-1],num_samples,0))
+    big=rng.rand(2000000,3).astype(np.float32)
+    _,exact_cost=timeit(furthest_point_sampling,big,num_samples,0)
+    _,approximate_cost=timeit(furthest_point_sampling,big,num_samples,0,True)
+    print("*"*30)
+    print("fps of %d from %d points" % (num_samples,num_points))
+    print("legacy           : %.4f s" % legacy_cost)
+    print("float32 in place : %.4f s (x%.1f)" % (engine_cost,legacy_cost/engine_cost))
+    print("batch of %d      : %.4f s, legacy loop %.4f s (x%.1f)" % (batch_size,batch_cost,legacy_batch_cost,legacy_batch_cost/batch_cost))
+    print("2M points exact  : %.4f s" % exact_cost)
+    print("2M approximate   : %.4f s (x%.1f)" % (approximate_cost,exact_cost/approximate_cost))
+
+if __name__=='__main__':
+    camera=RGBDCamera()
+    benchmark_backprojection(camera)
+    benchmark_fusion(camera)
+    benchmark_ply_writer()
+    benchmark_furthest_point_sampling()
@@ -0,0 +1,173 @@
+"""
+Spatial index of a point cloud
+PointCloud wraps the numpy arrays of a cloud (no open3d round trip) and builds its KD-tree
+(scipy cKDTree) or its voxel grid only once, on the first query which needs it, then every
+radius/knn/outlier/down sample query on the same cloud reuses it.
+The queries return index arrays into the cloud instead of copying the points, so several
+filters can be combined with numpy (np.intersect1d, boolean masks) and the points are only
+copied once at the end with select().
+The outlier removals and the voxel grid follow the definitions of open3d.
+EX:
+cloud=PointCloud(xyz_points,rgb_points)
+inliers=cloud.statistical_outlier_indices(nb_neighbors=20,std_ratio=2.0)
+inliers=np.intersect1d(inliers,cloud.radius_outlier_indices(nb_points=16,radius=0.005))
+filtered=cloud.select(inliers)
+sparse=filtered.select(filtered.voxel_down_sample_indices(0.002))
+"""
+import threading
+import numpy as np
+
+# scipy 1.6 renamed n_jobs to workers(and removed n_jobs in 1.9), return_length needs scipy>=1.3
+def _parallel_keyword():
+    import scipy
+    version=tuple(int(part) for part in scipy.__version__.split('.')[:2])
+    if version>=(1,6):
+        return {'workers':-1}
+    return {'n_jobs':-1}
+
+class PointCloud():
+    """
+    xyz: (N,3), rgb: (N,3) uint8 or None
+    The arrays are not copied, do not change them while the cloud is used.
+    """
+    def __init__(self,xyz,rgb=None,leafsize=16):
+        self.xyz=np.asarray(xyz)
+        self.rgb=None if rgb is None else np.asarray(rgb)
+        if self.xyz.ndim!=2 or self.xyz.shape[1]!=3:
+            raise Exception("xyz should be (N,3), not %s." % (self.xyz.shape,))
+        if self.rgb is not None and len(self.rgb)!=len(self.xyz):
+            raise Exception("xyz and rgb have different number of points.")
+        self.leafsize=leafsize
+        self._tree=None
+        # keyword of the parallel cKDTree queries, depends on the scipy version
+        self._parallel=None
+        # (k, distances, indices) of the largest knn asked so far
+        self._knn=None
+        self._radius_counts={}
+        self._voxel_grids={}
+        self._lock=threading.Lock()
+    def __len__(self):
+        return len(self.xyz)
+    # KD-tree, built on the first call
+    @property
+    def tree(self):
+        with self._lock:
+            if self._tree is None:
+                # scipy.spatial is imported with the first tree, not with the server
+                from scipy.spatial import cKDTree
+                self._parallel=_parallel_keyword()
+                self._tree=cKDTree(self.xyz,leafsize=self.leafsize)
+            return self._tree
+    """
+    k nearest neighbours of every point of the cloud, the point itself is the first one
+    return: distances (N,k), indices (N,k)
+    """
+    def knn(self,k):
+        knn=self._knn
+        if knn is None or knn[0]<k:
+            tree=self.tree
+            distances,indices=tree.query(self.xyz,k=k,**self._parallel)
+            if k==1:
+                distances,indices=distances[:,np.newaxis],indices[:,np.newaxis]
+            knn=self._knn=(k,distances,indices)
+        return knn[1][:,:k],knn[2][:,:k]
+    # k nearest neighbours of other points, return: distances (M,k), indices (M,k)
+    def knn_query(self,points,k):
+        distances,indices=self.tree.query(np.asarray(points).reshape(-1,3),k=k)
+        if k==1:
+            distances,indices=distances[:,np.newaxis],indices[:,np.newaxis]
+        return distances,indices
+    """
+    Indices of the points within radius of point
+    point: (3,) -> index array, (M,3) -> list of M index arrays
+    """
+    def radius_query(self,point,radius):
+        point=np.asarray(point)
+        result=self.tree.query_ball_point(point,radius)
+        if point.ndim==1:
+            return np.asarray(result,dtype=np.int64)
+        return [np.asarray(indices,dtype=np.int64) for indices in result]
+    # number of points within radius of every point(itself included), cached per radius
+    def radius_counts(self,radius):
+        counts=self._radius_counts.get(radius)
+        if counts is None:
+            tree=self.tree
+            counts=tree.query_ball_point(self.xyz,radius,return_length=True,**self._parallel)
+            self._radius_counts[radius]=counts
+        return counts
+    """
+    Voxel grid of open3d: the grid starts half a voxel below the min bound
+    return: first (V,) index of the first point of every voxel, inverse (N,) voxel of every
+    point, counts (V,) points per voxel. Cached per voxel_size.
+    """
+    def voxel_grid(self,voxel_size):
+        grid=self._voxel_grids.get(voxel_size)
+        if grid is None and len(self)==0:
+            empty=np.empty(0,dtype=np.int64)
+            return empty,empty,empty
+        if grid is None:
+            min_bound=self.xyz.min(axis=0).astype(np.float64)-voxel_size*0.5
+            voxel=np.floor((self.xyz-min_bound)/voxel_size).astype(np.int64)
+            dims=voxel.max(axis=0)+1
+            keys=(voxel[:,0]*dims[1]+voxel[:,1])*dims[2]+voxel[:,2]
+            _,first,inverse,counts=np.unique(keys,return_index=True,return_inverse=True,return_counts=True)
+            grid=(first,inverse.reshape(-1),counts)
+            self._voxel_grids[voxel_size]=grid
+        return grid
+    # ==========================================================
+    # Filters, all of them return the indices of the kept points
+    # ==========================================================
+    """
+    Statistical outlier removal(open3d remove_statistical_outlier)
+    the mean distance to the nb_neighbors nearest points(itself included) must be below
+    mean+std_ratio*std of all the points
+    """
+    def statistical_outlier_indices(self,nb_neighbors=20,std_ratio=2.0):
+        if len(self)==0:
+            return np.empty(0,dtype=np.int64)
+        # like open3d, a small cloud uses the neighbours it has(cKDTree would pad with inf)
+        distances,_=self.knn(min(nb_neighbors,len(self)))
+        mean_distances=distances.mean(axis=1)
+        # open3d ignores points whose neighbours are all at the same place
+        valid=mean_distances>0
+        if np.count_nonzero(valid)<2:
+            return np.flatnonzero(valid)
+        threshold=mean_distances[valid].mean()+std_ratio*mean_distances[valid].std(ddof=1)
+        return np.flatnonzero(valid&(mean_distances<threshold))
+    # Radius outlier removal(open3d remove_radius_outlier): more than nb_points points within radius
+    def radius_outlier_indices(self,nb_points=16,radius=0.05):
+        if len(self)==0:
+            return np.empty(0,dtype=np.int64)
+        return np.flatnonzero(self.radius_counts(radius)>nb_points)
+    # one point(the first one) of every voxel
+    def voxel_down_sample_indices(self,voxel_size):
+        first,_,_=self.voxel_grid(voxel_size)
+        return first
+    def uniform_down_sample_indices(self,every_k_points):
+        return np.arange(0,len(self),every_k_points)
+    # new PointCloud with the points of indices(or all the others with invert=True)
+    def select(self,indices,invert=False):
+        indices=np.asarray(indices)
+        if invert:
+            keep=np.ones(len(self),dtype=bool)
+            keep[indices]=False
+            indices=np.flatnonzero(keep)
+        rgb=None if self.rgb is None else self.rgb[indices]
+        return PointCloud(self.xyz[indices],rgb,self.leafsize)
+
+if __name__=='__main__':
+    import time
+    rng=np.random.RandomState(0)
+    # a sphere with some noise points around it
+    surface=rng.randn(200000,3)
+    surface=0.05*surface/np.linalg.norm(surface,axis=1)[:,None]
+    noise=rng.uniform(-0.1,0.1,(2000,3))
+    cloud=PointCloud(np.concatenate([surface,noise]).astype(np.float32))
+    for i in range(3):
+        start=time.perf_counter()
+        statistical=cloud.statistical_outlier_indices(20,2.0)
+        radius=cloud.radius_outlier_indices(16,0.002)
+        print("filters %d: %.3f s" % (i,time.perf_counter()-start))
+    inliers=np.intersect1d(statistical,radius)
+    print("kept %d of %d points, noise kept: %d" % (len(inliers),len(cloud),np.count_nonzero(inliers>=len(surface))))
+    print("voxel down sample:",len(cloud.voxel_down_sample_indices(0.002)))
@@ -1,11 +1,22 @@
 from PIL import Image
-import open3d as o3d
-from matplotlib import pyplot as plt
 import numpy as np
-from mpl_toolkits.mplot3d import Axes3D
 import cv2
-from sklearn.decomposition import PCA
-from scipy.spatial.transform import Rotation as R
+from Utils.compact_mask import CompactMask
+from Utils.point_cloud_index import PointCloud
+from Utils.metrics import span
+# open3d, matplotlib, sklearn and scipy take seconds to import and the server only needs the
+# numpy engine, so they are imported by the functions which use them(show, pca, open3d objects)
+def _open3d():
+    import open3d
+    return open3d
+def _pyplot():
+    from matplotlib import pyplot
+    # registers the '3d' projection
+    from mpl_toolkits.mplot3d import Axes3D
+    return pyplot
+def _rotation():
+    from scipy.spatial.transform import Rotation
+    return Rotation
 
 # ====================================================
 # 座標轉換功能
@@ -25,6 +36,7 @@ def quaterion_to_tfMatrix(quaterion):
         raise Exception("Make sure your format can fit what we provide.")
     t_matrix=np.zeros((4,4))
     translation_vector=np.array(quaterion[:3])
+    R = _rotation()
     r = R.from_quat(quaterion[3:])
     r_matrix=r.as_dcm()
     t_matrix[0:3,0:3]=r_matrix
@@ -106,33 +118,59 @@ return:
 list(for saving)),nparray(for dealing with data)
 """
 def mask_to_partial_pointcloud(color,depth,mask,camera):
-    color_img = Image.fromarray(color.astype('uint8'), 'RGB')
-    depth_img = Image.fromarray(depth)
-    mask_img = Image.fromarray(mask)
-    if color_img.size != depth_img.size:
+    xyz_points,rgb_points=backproject_masked_rgbd(color,depth,mask,camera)
+    points=points_to_ply_lines(xyz_points,rgb_points)
+    return points,xyz_points
+"""
+Whole-frame back-projection engine
+color: (H,W,3) rgb nparray
+depth: (H,W) uint16 nparray (aligned to color)
+mask: (H,W) nparray, 0 means background, or CompactMask(只會decode bbox的部分)
+一次把整張frame算完 不再逐個pixel用getpixel
+像素的順序跟原本的for v: for u: 一樣 (row-major)
+return:
+xyz (N,3) float32 (unit: meter), rgb (N,3) uint8
+"""
+def backproject_masked_rgbd(color,depth,mask,camera):
+    with span('back_project'):
+        color,depth,mask=_check_rgbd_view(color,depth,mask)
+        v,u=_masked_pixels(depth,mask)
+        xyz_points=np.empty((len(v),3),dtype=np.float32)
+        rgb_points=np.empty((len(v),3),dtype=np.uint8)
+        _backproject_pixels(color,depth,v,u,camera,xyz_points,rgb_points)
+    return xyz_points,rgb_points
+def _check_rgbd_view(color,depth,mask):
+    color=np.asarray(color)
+    depth=np.asarray(depth)
+    if not isinstance(mask,CompactMask):
+        mask=np.asarray(mask)
+    if color.shape[:2] != depth.shape or depth.shape != mask.shape:
         raise Exception("Color and depth image do not have the same resolution.")
-    if color_img.mode != "RGB":
+    if color.ndim != 3 or color.shape[2] != 3:
         raise Exception("Color image is not in RGB format")
-    if depth_img.mode != "I;16":
+    if not np.issubdtype(depth.dtype,np.integer):
         raise Exception("Depth image is not in intensity format")
-    # gray image 0-255
-    if mask_img.mode != "L":
-        raise Exception("Depth image is not in gray image format")
-    points = []
-    xyz_points=[]
-    #if the size of photo is (480,640) in opencv, then its size would be (640,480) in PIL 
-    for v in range(color_img.size[1]):
-        for u in range(color_img.size[0]):
-            color = color_img.getpixel((u,v))
-            # scaling factor can transform the unit from minimeter to meter
-            Z = depth_img.getpixel((u,v)) * camera.scalingfactor
-            # mask==0 或者z==0 都是略過
-            if Z==0 or mask_img.getpixel((u,v))==0: continue
-            X = (u - camera.cx) * Z / camera.fx
-            Y = (v - camera.cy) * Z / camera.fy
-            xyz_points.append([X,Y,Z])
-            points.append("%f %f %f %d %d %d 0\n"%(X,Y,Z,color[0],color[1],color[2]))
-    return points,np.array(xyz_points)
+    return color,depth,mask
+# mask==0 或者z==0 都是略過
+def _masked_pixels(depth,mask):
+    if isinstance(mask,CompactMask):
+        v,u=mask.nonzero()
+        valid=depth[v,u]!=0
+        return v[valid],u[valid]
+    return np.nonzero((depth!=0)&(mask!=0))
+# 把(v,u)這些pixel寫進out_xyz,out_rgb (長度要一樣)
+def _backproject_pixels(color,depth,v,u,camera,out_xyz,out_rgb):
+    # ray grid已經把scaling factor(mm->m)跟內參算好了 只要乘上depth
+    rays=camera.ray_grid(depth.shape[1],depth.shape[0])
+    np.multiply(rays[v,u],depth[v,u][:,np.newaxis],out=out_xyz)
+    out_rgb[:]=color[v,u]
+"""
+把 (N,3) xyz 跟 (N,3) rgb 轉回舊的ply字串格式
+給還在用 savePoints_to_ply 的地方使用
+"""
+def points_to_ply_lines(xyz_points,rgb_points):
+    return ["%f %f %f %d %d %d 0\n"%(x,y,z,r,g,b)
+            for (x,y,z),(r,g,b) in zip(xyz_points.tolist(),rgb_points.tolist())]
 """
 Mask版本的join map
 MaskRCNN出來的Mask存成list
@@ -151,34 +189,50 @@ mask=cv2.imread('./dataset/mask.png',cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
 color_img = Image.fromarray(color.astype('uint8'), 'RGB')
 depth_img = Image.fromarray(depth)
 mask_img = Image.fromarray(mask)
+現在也可以直接傳入realsense的nparray 不需要再轉成Image
 ======================================================
 Return ply type points,points(np type)
 """
 def join_map_with_mask(pose_list,color_list,depth_list,mask_list,camera):
+    xyz_points,rgb_points=fuse_masked_views(pose_list,color_list,depth_list,mask_list,camera)
+    points=points_to_ply_lines(xyz_points,rgb_points)
+    return points,xyz_points
+"""
+Batched multi-view fusion
+pose_list: 4x4 transformation matrix(camera->base) of every view, ex: CURRENT_POSTION from create_6dof
+color_list,depth_list,mask_list: nparray(或是Image) of every view, mask也可以是CompactMask
+每個view只做一次整張的back-projection 跟一次矩陣乘法轉到base frame
+所有view直接寫進一開始就配置好的buffer 不會一直append list
+return:
+xyz (N,3) float32 in base frame, rgb (N,3) uint8
+"""
+def fuse_masked_views(pose_list,color_list,depth_list,mask_list,camera):
+    with span('fuse'):
+        return _fuse_masked_views(pose_list,color_list,depth_list,mask_list,camera)
+def _fuse_masked_views(pose_list,color_list,depth_list,mask_list,camera):
     if(len(pose_list)!=len(color_list) or len(pose_list)!=len(depth_list) or len(pose_list)!=len(mask_list)):
         raise Exception("Color and depth image do not have the same resolution, or the number of photos do not match the num of pose!")
-    points=[]
-    xyz_points=[]
-    # print(len(pose_list))
+    views=[]
+    total=0
     for i in range(len(pose_list)):
-        rgb = color_list[i]
-        depth = depth_list[i]
-        # 這邊的v=480 u=640
-        for v in range(rgb.size[1]):
-            for u in range(rgb.size[0]):
-                color = rgb.getpixel((u,v))
-                Z = depth.getpixel((u,v)) * camera.scalingfactor
-                if Z==0 or mask_list[i].getpixel((u,v))==0: continue
-                X = (u - camera.cx) * Z / camera.fx
-                Y = (v - camera.cy) * Z / camera.fy
-                # 這個地方注意是做作標轉換的地方
-                # ======================================
-                point_in_camera=np.array([X,Y,Z,1])
-                world_point=pose_list[i].dot(point_in_camera)
-                # ======================================
-                xyz_points.append([world_point[0],world_point[1],world_point[2]])
-                points.append("%f %f %f %d %d %d 0\n"%(world_point[0],world_point[1],world_point[2],color[0],color[1],color[2]))
-    return points,np.array(xyz_points)
+        if pose_list[i] is None:
+            raise Exception("The pose of view %d is missing, send the 6dof before taking photos." % i)
+        color,depth,mask=_check_rgbd_view(color_list[i],depth_list[i],mask_list[i])
+        v,u=_masked_pixels(depth,mask)
+        views.append((color,depth,v,u))
+        total+=len(v)
+    xyz_points=np.empty((total,3),dtype=np.float32)
+    rgb_points=np.empty((total,3),dtype=np.uint8)
+    start=0
+    for i,(color,depth,v,u) in enumerate(views):
+        end=start+len(v)
+        view_xyz=xyz_points[start:end]
+        _backproject_pixels(color,depth,v,u,camera,view_xyz,rgb_points[start:end])
+        # 這個地方注意是做作標轉換的地方 [R|t] 一次乘完整個view
+        pose=np.asarray(pose_list[i],dtype=np.float32)
+        view_xyz[:]=view_xyz.dot(pose[0:3,0:3].T)+pose[0:3,3]
+        start=end
+    return xyz_points,rgb_points
 # ==========================================================
 # Saving/read pc, basic manipulation to pc
 # ==========================================================
@@ -202,16 +256,219 @@ def savePoints_to_ply(dirname,filename,points):
         %s
         '''%(len(points),"".join(points)))
     file.close()
+"""
+存nparray 變成點雲文件 (不用先轉成字串)
+xyz_points: (N,3) float, rgb_points: (N,3) uint8 or None
+file_format: 'binary_little_endian'(預設, 大約是ascii的1/3大小) or 'ascii'
+chunk_size: 一次寫入的點數 用來限制暫存記憶體
+"""
+def save_pointcloud_to_ply(dirname,filename,xyz_points,rgb_points=None,file_format='binary_little_endian',chunk_size=1<<20):
+    with span('ply_write'),PlyWriter(dirname+'/'+filename,file_format=file_format,vertex_count=len(xyz_points)) as writer:
+        for start in range(0,len(xyz_points),chunk_size):
+            writer.write(xyz_points[start:start+chunk_size],
+                         None if rgb_points is None else rgb_points[start:start+chunk_size])
+# 跟 savePoints_to_ply 一樣的vertex格式 (alpha一律是0)
+PLY_VERTEX_DTYPE=np.dtype([
+    ('x','<f4'),('y','<f4'),('z','<f4'),
+    ('red','u1'),('green','u1'),('blue','u1'),('alpha','u1')
+])
+"""
+Streaming PLY writer
+每次write一個chunk的nparray 用structured dtype一次寫進檔案
+不知道總點數的話(vertex_count=None) header會先留空間 close的時候再補上
+ex:
+with PlyWriter('pointnet_data_v3/cloud.ply') as writer:
+    for xyz,rgb in chunks:
+        writer.write(xyz,rgb)
+"""
+class PlyWriter():
+    COUNT_WIDTH=12
+    def __init__(self,path,file_format='binary_little_endian',vertex_count=None):
+        if file_format not in ('binary_little_endian','ascii'):
+            raise Exception("PLY format should be binary_little_endian or ascii")
+        self.file_format=file_format
+        self.vertex_count=vertex_count
+        self.count=0
+        self.file=open(path,'wb')
+        self.file.write(("ply\nformat %s 1.0\nelement vertex " % file_format).encode('ascii'))
+        self._count_offset=self.file.tell()
+        count=str(vertex_count) if vertex_count is not None else ''
+        header=count.ljust(self.COUNT_WIDTH)+"\n"
+        header+="".join("property %s %s\n" % ('float' if PLY_VERTEX_DTYPE[name].kind=='f' else 'uchar',name)
+                        for name in PLY_VERTEX_DTYPE.names)
+        header+="end_header\n"
+        self.file.write(header.encode('ascii'))
+    def write(self,xyz_points,rgb_points=None):
+        if self.file_format=='binary_little_endian':
+            vertices=np.zeros(len(xyz_points),dtype=PLY_VERTEX_DTYPE)
+            vertices['x']=xyz_points[:,0]
+            vertices['y']=xyz_points[:,1]
+            vertices['z']=xyz_points[:,2]
+            if rgb_points is not None:
+                vertices['red']=rgb_points[:,0]
+                vertices['green']=rgb_points[:,1]
+                vertices['blue']=rgb_points[:,2]
+            vertices.tofile(self.file)
+        else:
+            rgb=np.zeros((len(xyz_points),3),dtype=np.uint8) if rgb_points is None else rgb_points
+            self.file.write("".join(points_to_ply_lines(xyz_points,rgb)).encode('ascii'))
+        self.count+=len(xyz_points)
+    def close(self):
+        if self.file.closed:
+            return
+        if self.vertex_count is None:
+            self.file.seek(self._count_offset)
+            self.file.write(str(self.count).ljust(self.COUNT_WIDTH).encode('ascii'))
+        elif self.vertex_count!=self.count:
+            self.file.close()
+            raise Exception("Expect %d points in the ply file but %d were written." % (self.vertex_count,self.count))
+        self.file.close()
+    def __enter__(self):
+        return self
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is not None:
+            self.file.close()
+        else:
+            self.close()
 def show_ply_file(dirname,filename):
+    o3d = _open3d()
     pcd = o3d.io.read_point_cloud(dirname+"/"+filename)
     o3d.visualization.draw_geometries([pcd])
 
 # 從ply 檔案得到所有點
+# binary ply 會直接回傳memmap的view(不會複製), 可以in-place修改但不會寫回檔案
 def get_ply_file_points(dirname,filename):
-    pcd = o3d.io.read_point_cloud(dirname+"/"+filename)
-    # print(pcd)
-    points=np.asarray(pcd.points)
-    return points
+    return PlyPointCloud(dirname+"/"+filename).xyz
+"""
+Memory-mapped PLY reader
+binary_little_endian: 直接memmap檔案 xyz/rgb 都是zero-copy的nparray view
+ascii: 沒辦法memmap (舊的savePoints_to_ply存的檔案), 第一次用到xyz/rgb/vertices才整個parse
+iter_chunks不會觸發整個parse
+mode='c' 是copy-on-write, 對回傳的array做修改不會改到檔案
+ex:
+cloud=PlyPointCloud('pointnet_data_v3/cloud.ply')
+cloud.xyz  -> (N,3) view
+cloud.rgb  -> (N,3) uint8 view or None
+for xyz,rgb in cloud.iter_chunks(100000):
+    ...
+"""
+PLY_PROPERTY_TYPES={
+    'char':'i1','int8':'i1','uchar':'u1','uint8':'u1',
+    'short':'i2','int16':'i2','ushort':'u2','uint16':'u2',
+    'int':'i4','int32':'i4','uint':'u4','uint32':'u4',
+    'float':'f4','float32':'f4','double':'f8','float64':'f8'
+}
+class PlyPointCloud():
+    def __init__(self,path,mode='c'):
+        self.path=path
+        self.file_format,self.vertex_count,self.dtype,self.data_offset=read_ply_header(path)
+        if self.file_format=='binary_little_endian':
+            self._buffer=np.memmap(path,dtype=np.uint8,mode=mode,offset=self.data_offset,
+                                   shape=(self.vertex_count*self.dtype.itemsize,))
+            self._vertices=np.ndarray((self.vertex_count,),dtype=self.dtype,buffer=self._buffer)
+        elif self.file_format=='ascii':
+            self._buffer=None
+            # parse on the first access
+            self._vertices=None
+        else:
+            raise Exception("PLY format %s is not supported." % self.file_format)
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            self._vertices=np.concatenate([chunk for chunk in self.iter_vertex_chunks(1<<20)]
+                                          +[np.zeros(0,dtype=self.dtype)])
+        return self._vertices
+    @property
+    def xyz(self):
+        return self._field_view(self.vertices,('x','y','z'))
+    @property
+    def rgb(self):
+        if 'red' not in self.dtype.names:
+            return None
+        return self._field_view(self.vertices,('red','green','blue'))
+    """
+    Lazy iterator for files too big to load
+    binary: 每個chunk都是memmap的view, 只有被讀到的page才會進記憶體
+    ascii: 一次只parse chunk_size行
+    """
+    def iter_chunks(self,chunk_size=1<<20):
+        has_color='red' in self.dtype.names
+        for chunk in self.iter_vertex_chunks(chunk_size):
+            rgb=self._field_view(chunk,('red','green','blue')) if has_color else None
+            yield self._field_view(chunk,('x','y','z')),rgb
+    # structured vertex chunks, ascii已經parse過的話就直接切
+    def iter_vertex_chunks(self,chunk_size=1<<20):
+        if self._vertices is not None:
+            return (self._vertices[start:start+chunk_size] for start in range(0,self.vertex_count,chunk_size))
+        return _iter_ascii_vertices(self.path,self.dtype,self.vertex_count,chunk_size,self.data_offset)
+    # 三個field是連續而且同樣型態的話就回傳(N,3)的view 不然只能複製
+    def _field_view(self,vertices,names):
+        fields=[self.dtype.fields[name] for name in names]
+        field_dtype,offset=fields[0][0],fields[0][1]
+        contiguous=all(f[0]==field_dtype and f[1]==offset+i*field_dtype.itemsize for i,f in enumerate(fields))
+        if contiguous and vertices.base is not None:
+            return np.ndarray((len(vertices),3),dtype=field_dtype,buffer=vertices,offset=offset,
+                              strides=(self.dtype.itemsize,field_dtype.itemsize))
+        return np.stack([vertices[name] for name in names],axis=1)
+"""
+讀ply的header
+return: format, vertex數量, vertex的structured dtype, data開始的byte offset
+舊的savePoints_to_ply存出來的header每行前面有空白 這邊一起處理
+"""
+def read_ply_header(path):
+    file_format=None
+    vertex_count=None
+    properties=[]
+    current_element=None
+    with open(path,'rb') as file:
+        if file.readline().strip()!=b'ply':
+            raise Exception("%s is not a ply file." % path)
+        while True:
+            line=file.readline()
+            if not line:
+                raise Exception("Can not find end_header in %s." % path)
+            words=line.decode('ascii').split()
+            if not words or words[0] in ('comment','obj_info'):
+                continue
+            if words[0]=='end_header':
+                break
+            if words[0]=='format':
+                file_format=words[1]
+            elif words[0]=='element':
+                # vertex要是第一個element 後面的element(face...)就不管了
+                if vertex_count is None and words[1]!='vertex':
+                    raise Exception("The vertex element should be the first element in %s." % path)
+                current_element=words[1]
+                if current_element=='vertex':
+                    vertex_count=int(words[2])
+            elif words[0]=='property' and current_element=='vertex':
+                if words[1]=='list':
+                    raise Exception("List property in vertex is not supported.")
+                properties.append((words[2],'<'+PLY_PROPERTY_TYPES[words[1]]))
+        data_offset=file.tell()
+    if vertex_count is None:
+        raise Exception("There is no vertex element in %s." % path)
+    return file_format,vertex_count,np.dtype(properties),data_offset
+def _iter_ascii_vertices(path,dtype,vertex_count,chunk_size,data_offset=None):
+    if data_offset is None:
+        data_offset=read_ply_header(path)[3]
+    with open(path,'rb') as file:
+        file.seek(data_offset)
+        remain=vertex_count
+        while remain>0:
+            lines=[]
+            while len(lines)<min(chunk_size,remain):
+                line=file.readline()
+                if not line:
+                    raise Exception("%s has less points than its header." % path)
+                if line.strip():
+                    lines.append(line)
+            rows=np.array([line.split() for line in lines],dtype=np.float64)
+            chunk=np.empty(len(rows),dtype=dtype)
+            for i,name in enumerate(dtype.names):
+                chunk[name]=rows[:,i]
+            remain-=len(chunk)
+            yield chunk
 # 上面的point cloud傳入的是numpy
 # 這邊傳入純粹就是x,y,z的值
 """
@@ -231,6 +488,7 @@ xyz_points:numpy
 """
 def show_centriod(xyz_points,title_name):
     x_mean,y_mean,z_mean=get_centroid_from_pc(xyz_points)
+    plt = _pyplot()
     ax = plt.subplot(111, projection='3d')  # 创建一个三维的绘图工程
     #  将数据点分成三部分画，在颜色上有区分度
     ax.scatter(xyz_points[:,0], xyz_points[:,1], xyz_points[:,2], c='b',s=1)  # 绘制数据点
@@ -256,8 +514,8 @@ def normalize_point_cloud(points):
 """
 這邊提供兩種方式一種是voxel的方式 voxel size越大代表取的量越少
 參數method傳入字典的格式:
-注意這邊傳入的是open3d point cloud的形式 is_show參數選擇要不要看差異
-假如是要傳入numpy形式 要先轉成open3d的形式
+傳入open3d point cloud的話 用open3d的function
+傳入numpy形式的話 用下面numpy的function做完 回傳前才轉成open3d
 input:
 numpy or open3d point cloud
 output:
@@ -276,41 +534,91 @@ function={
 def point_cloud_down_sample_from_file(dirname,filename,function={}):
     if len(function)<2:
         raise SystemExit('You should pass the third parameter as dict')
-    pcd = o3d.io.read_point_cloud(dirname+"/"+filename)
-    if(function['method']=='voxel'):
-        down_pcd = pcd.voxel_down_sample(voxel_size=function['voxel_size'])
-    elif(function['method']=='uniform'):
-        down_pcd = pcd.uniform_down_sample(every_k_points=function['every_k_points'])
-    else:
-        raise SystemExit('Make sure the name of method is correct!!!')
-    return down_pcd
+    path=dirname+"/"+filename
+    if not _is_numpy_ply(path):
+        # .pcd/.xyz/big endian ply...: 還是用open3d讀跟down sample
+        return point_cloud_down_sample_from_pc(_open3d().io.read_point_cloud(path),function)
+    # 用memmap讀入 不經過open3d的parser, down sample也是numpy做完 最後才轉成open3d
+    cloud=PlyPointCloud(path)
+    xyz_points,rgb_points=_down_sample_numpy(np.asarray(cloud.xyz),function,cloud.rgb)
+    return _to_open3d(xyz_points,rgb_points)
+# PlyPointCloud讀得了的檔案: binary_little_endian或ascii的ply
+def _is_numpy_ply(path):
+    try:
+        file_format=read_ply_header(path)[0]
+    except Exception:
+        return False
+    return file_format in ('binary_little_endian','ascii')
 def point_cloud_down_sample_from_pc(cloud,function={}):
     if len(function)<2:
         raise SystemExit('You should pass the third parameter as dict')
     if(type(cloud).__module__==np.__name__):
         print("你傳入numpy array形式")
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(cloud)
-        if(function['method']=='voxel'):
-            down_pcd = pcd.voxel_down_sample(voxel_size=function['voxel_size'])
-        elif(function['method']=='uniform'):
-            down_pcd = pcd.uniform_down_sample(every_k_points=function['every_k_points'])
-        else:
-            raise SystemExit('Make sure the name of method is correct!!!')
+        # numpy engine(voxel_down_sample/uniform_down_sample) 只在回傳時轉一次open3d
+        xyz_points,_=_down_sample_numpy(cloud,function)
+        down_pcd = _to_open3d(xyz_points)
     else:
         if(function['method']=='voxel'):
             down_pcd = cloud.voxel_down_sample(voxel_size=function['voxel_size'])
         elif(function['method']=='uniform'):
             down_pcd = cloud.uniform_down_sample(every_k_points=function['every_k_points'])
+        else:
+            raise SystemExit('Make sure the name of method is correct!!!')
     return down_pcd
+"""
+Down sampling on numpy arrays, no open3d round trip
+xyz_points: (N,3) numpy(float32 stays float32) or PointCloud(then its voxel grid is reused)
+rgb_points: (N,3) uint8 or None, the colors are carried along
+voxel: same grid and result as open3d voxel_down_sample, the mean point and color of every voxel
+uniform: every k-th point, the returned arrays are views(no copy)
+return: xyz_points, rgb_points(None without colors)
+ex:
+xyz,rgb=voxel_down_sample(xyz,0.002,rgb)
+"""
+def voxel_down_sample(xyz_points,voxel_size,rgb_points=None):
+    cloud=_as_point_cloud(xyz_points,rgb_points)
+    if len(cloud)==0:
+        return cloud.xyz,cloud.rgb
+    _,inverse,counts=cloud.voxel_grid(voxel_size)
+    xyz_down=np.empty((len(counts),3),dtype=np.float32 if cloud.xyz.dtype==np.float32 else np.float64)
+    for axis in range(3):
+        xyz_down[:,axis]=np.bincount(inverse,weights=cloud.xyz[:,axis])/counts
+    rgb_down=None
+    if cloud.rgb is not None:
+        rgb_down=np.empty((len(counts),3),dtype=np.uint8)
+        for axis in range(3):
+            rgb_down[:,axis]=np.rint(np.bincount(inverse,weights=cloud.rgb[:,axis])/counts)
+    return xyz_down,rgb_down
+def uniform_down_sample(xyz_points,every_k_points,rgb_points=None):
+    cloud=_as_point_cloud(xyz_points,rgb_points)
+    rgb_down=None if cloud.rgb is None else cloud.rgb[::every_k_points]
+    return cloud.xyz[::every_k_points],rgb_down
+def _down_sample_numpy(xyz_points,function,rgb_points=None):
+    if(function['method']=='voxel'):
+        return voxel_down_sample(xyz_points,function['voxel_size'],rgb_points)
+    elif(function['method']=='uniform'):
+        return uniform_down_sample(xyz_points,function['every_k_points'],rgb_points)
+    raise SystemExit('Make sure the name of method is correct!!!')
+# numpy -> open3d point cloud (rgb uint8 -> colors 0~1)
+def _to_open3d(xyz_points,rgb_points=None):
+    o3d = _open3d()
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(np.asarray(xyz_points,dtype=np.float64))
+    if rgb_points is not None:
+        pcd.colors = o3d.utility.Vector3dVector(np.asarray(rgb_points)/255.0)
+    return pcd
+def _as_point_cloud(xyz_points,rgb_points=None):
+    if isinstance(xyz_points,PointCloud):
+        return xyz_points
+    return PointCloud(xyz_points,rgb_points)
 # ===========================================================
 # Outlier removal function
 # ===========================================================
 """
 Statistical outlier removal
 Radius outlier removal
-注意這邊傳入的是open3d point cloud的形式 is_show參數選擇要不要看差異
-假如是要傳入numpy形式 要先轉成open3d的形式
+傳入open3d point cloud的話 用open3d的function is_show參數選擇要不要看差異
+傳入numpy形式的話 用下面numpy的function做完 回傳前才轉成open3d
 ex:
 function={
     'method':'statistical',
@@ -331,11 +639,11 @@ def display_inlier_outlier(cloud, ind,is_show):
     if(is_show):
         outlier_cloud.paint_uniform_color([1, 0, 0])
         inlier_cloud.paint_uniform_color([0.8, 0.8, 0.8])
-        o3d.visualization.draw_geometries([inlier_cloud, outlier_cloud])
+        _open3d().visualization.draw_geometries([inlier_cloud, outlier_cloud])
     return inlier_cloud
 """
-這邊的removal 用到的是open3d裡面的outlier removal 所以
-return 的形式會是pcd的object
+numpy形式的removal 是statistical_outlier_removal/radius_outlier_removal
+不管傳入哪一種 return 的形式都會是pcd的object
 因此要把點取出來的話要用np.asarray(pc_after_removal.points)
 將points的array用np的方式取出來
 output:
@@ -346,14 +654,17 @@ def point_cloud_outlier_removal(cloud,is_show=False,function={}):
         raise SystemExit('You should pass the third parameter as dict')
     if(type(cloud).__module__==np.__name__):
         print("你傳入numpy array形式")
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(cloud)      
+        # numpy engine(statistical_outlier_removal/radius_outlier_removal) 只在回傳時轉一次open3d
         if(function['method']=='statistical'):
-            cl, ind = pcd.remove_statistical_outlier(nb_neighbors=function['nb_neighbors'],std_ratio=function['std_ratio'])
+            xyz_points,_,ind = statistical_outlier_removal(cloud,function['nb_neighbors'],function['std_ratio'])
         elif(function['method']=='radius'):
-            cl, ind = pcd.remove_radius_outlier(nb_points=function['nb_points'], radius=function['radius'])
-
-        pc_after_removal=display_inlier_outlier(pcd, ind,is_show)
+            xyz_points,_,ind = radius_outlier_removal(cloud,function['nb_points'],function['radius'])
+        else:
+            raise SystemExit('Make sure the name of method is correct!!!')
+        if(is_show):
+            pc_after_removal=display_inlier_outlier(_to_open3d(cloud), ind.tolist(),is_show)
+        else:
+            pc_after_removal=_to_open3d(xyz_points)
     # 傳入open3d 的point cloud 形式
     else:
         if(function['method']=='statistical'):
@@ -362,6 +673,24 @@ def point_cloud_outlier_removal(cloud,is_show=False,function={}):
             cl, ind = cloud.remove_radius_outlier(nb_points=function['nb_points'], radius=function['radius'])
         pc_after_removal=display_inlier_outlier(cloud, ind,is_show)
     return pc_after_removal
+"""
+Outlier removal on numpy arrays, no open3d round trip
+Same definitions as open3d remove_statistical_outlier/remove_radius_outlier, the neighbours
+come from the KD-tree of PointCloud, pass a PointCloud to reuse it between several filters.
+xyz_points: (N,3) numpy or PointCloud, rgb_points: (N,3) uint8 or None
+return: xyz_points, rgb_points(None without colors), ind(the indices of the inliers)
+ex:
+xyz,rgb,ind=statistical_outlier_removal(xyz,20,2.0,rgb)
+"""
+def statistical_outlier_removal(xyz_points,nb_neighbors=20,std_ratio=2.0,rgb_points=None):
+    cloud=_as_point_cloud(xyz_points,rgb_points)
+    return _select_points(cloud,cloud.statistical_outlier_indices(nb_neighbors,std_ratio))
+def radius_outlier_removal(xyz_points,nb_points=16,radius=0.05,rgb_points=None):
+    cloud=_as_point_cloud(xyz_points,rgb_points)
+    return _select_points(cloud,cloud.radius_outlier_indices(nb_points,radius))
+def _select_points(cloud,ind):
+    rgb_points=None if cloud.rgb is None else cloud.rgb[ind]
+    return cloud.xyz[ind],rgb_points,ind
 # ===========================================================
 # The tool to analyze the shape of the point cloud
 # ===========================================================
@@ -377,11 +706,14 @@ second:
 singular values.
 """
 def cal_pca(point_cloud,is_show=False,desired_num_of_feature=3,title="pca demo"):
+    from sklearn.decomposition import PCA
     pca = PCA(n_components=desired_num_of_feature)
     pca.fit(point_cloud)
     # print("Principal vectors: ",pca.components_)
     # print("Singular values: ",pca.explained_variance_)
     if is_show:
+        plt = _pyplot()
+        R = _rotation()
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
         ax.set_xlabel('X Label(unit:m)')
@@ -472,15 +804,74 @@ def jitter_point_cloud(point_cloud, sigma=0.01, clip=0.05):
 """
 Furthest point sampling:
 這個function 會盡可能的分散選取特定數量的point cloud
+The distances are kept in one float32 buffer and updated in place, the coordinates are split
+per axis so every iteration is C contiguous passes over the cloud without temporary arrays.
+seed_index: index of the first point(int, or one per cloud for the batch), None -> random
+approximate=True: for millions of points, keep one point per voxel first and sample on them,
+the voxel size is chosen so there are about 8*K occupied voxels (or give voxel_size)
 """
 def calc_distances(p0, points):
     return ((p0 - points)**2).sum(axis=1)
-def furthest_point_sampling(pts, K):
-    N,C=pts.shape
-    farthest_pts = np.zeros((K, C))
-    farthest_pts[0] = pts[np.random.randint(len(pts))]
-    distances = calc_distances(farthest_pts[0], pts)
-    for i in range(1, K):
-        farthest_pts[i] = pts[np.argmax(distances)]
-        distances = np.minimum(distances, calc_distances(farthest_pts[i], pts))
-    return farthest_pts
\ No newline at end of file
+def furthest_point_sampling(pts, K, seed_index=None, approximate=False, voxel_size=None):
+    pts=np.asarray(pts)
+    if approximate:
+        index=furthest_point_sampling_approximate_indices(pts,K,seed_index,voxel_size)
+    else:
+        index=furthest_point_sampling_batch(pts[np.newaxis],K,seed_index)[0]
+    return pts[index]
+"""
+Batch of clouds with the same number of points
+pts: (B,N,C), seed_index: None, int or (B,)
+return: (B,K) int64 indices of the sampled points
+"""
+def furthest_point_sampling_batch(pts, K, seed_index=None):
+    pts=np.asarray(pts)
+    B,N,C=pts.shape
+    if K>N:
+        raise Exception("Can not sample %d points from %d points." % (K,N))
+    # (C,B,N) float32, one contiguous plane per axis
+    planes=np.ascontiguousarray(np.moveaxis(pts,2,0),dtype=np.float32)
+    batch=np.arange(B)
+    indices=np.empty((B,K),dtype=np.int64)
+    if seed_index is None:
+        indices[:,0]=np.random.randint(N,size=B)
+    else:
+        indices[:,0]=seed_index
+    distances=np.full((B,N),np.inf,dtype=np.float32)
+    new_distances=np.empty((B,N),dtype=np.float32)
+    difference=np.empty((B,N),dtype=np.float32)
+    for i in range(1,K):
+        last=indices[:,i-1]
+        new_distances.fill(0)
+        for axis in range(C):
+            plane=planes[axis]
+            np.subtract(plane,plane[batch,last][:,np.newaxis],out=difference)
+            np.multiply(difference,difference,out=difference)
+            new_distances+=difference
+        np.minimum(distances,new_distances,out=distances)
+        indices[:,i]=distances.argmax(axis=1)
+    return indices
+# one representative point per voxel, then exact fps on the representatives
+def furthest_point_sampling_approximate_indices(pts, K, seed_index=None, voxel_size=None):
+    pts=np.asarray(pts)
+    N=len(pts)
+    xyz=pts[:,0:3]
+    low=xyz.min(axis=0)
+    if voxel_size is None:
+        extent=np.maximum(xyz.max(axis=0)-low,1e-9)
+        voxel_size=float(np.prod(extent)/(8.0*K))**(1.0/3)
+    for _ in range(8):
+        voxel=np.floor((xyz-low)/voxel_size).astype(np.int64)
+        keys=(voxel[:,0]*(voxel[:,1].max()+1)+voxel[:,1])*(voxel[:,2].max()+1)+voxel[:,2]
+        _,representatives=np.unique(keys,return_index=True)
+        if len(representatives)>=4*K:
+            break
+        # surfaces occupy far less voxels than the volume, make the voxels smaller
+        voxel_size/=2.0
+    if len(representatives)<K:
+        return furthest_point_sampling_batch(pts[np.newaxis],K,seed_index)[0]
+    if seed_index is not None:
+        representatives=np.union1d(representatives,[seed_index])
+        seed_index=int(np.searchsorted(representatives,seed_index))
+    index=furthest_point_sampling_batch(pts[representatives][np.newaxis],K,seed_index)[0]
+    return representatives[index]
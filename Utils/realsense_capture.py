@@ -0,0 +1,137 @@
+"""
+Background RealSense capture service.
+A thread keeps calling pipeline.wait_for_frames() + align.process() and copies every aligned
+color/depth pair into a small ring buffer, so the request handlers do not wait for the camera
+anymore, they just copy the newest pair out.
+Every pair is tagged with the frame number, the camera timestamp(ms) and the host time(s),
+so it can be matched with the 6dof pose which was received at the same time.
+EX:
+capture=RealsenseCaptureService(pipeline,config,align)
+(or RealsenseCaptureService(factory=create_pipeline), create_pipeline() returns (pipeline,config,align)
+and is called by the first start, so pyrealsense2 is not touched before start_stream)
+capture.start()                             # start_stream
+frame=capture.latest(newer_than=time.time())
+frame.color, frame.depth, frame.host_time
+capture.stop()                              # finish_stream
+"""
+import threading
+import time
+import numpy as np
+from Utils.metrics import span
+
+class RGBDFrame():
+    def __init__(self,color,depth,frame_number,timestamp,host_time):
+        # color: (H,W,3) bgr uint8, depth: (H,W) uint16 aligned to color
+        self.color=color
+        self.depth=depth
+        self.frame_number=frame_number
+        self.timestamp=timestamp
+        self.host_time=host_time
+
+class RealsenseCaptureService():
+    def __init__(self,pipeline=None,config=None,align=None,ring_size=4,factory=None):
+        if pipeline is None and factory is None:
+            raise Exception("RealsenseCaptureService needs a pipeline or a factory.")
+        self.factory=factory
+        self.pipeline=pipeline
+        self.config=config
+        self.align=align
+        self.ring_size=ring_size
+        self._colors=None
+        self._depths=None
+        self._info=[None]*ring_size
+        self._newest=-1
+        self._running=False
+        self._thread=None
+        # last error of the capture thread, shown when latest() times out
+        self.last_error=None
+        self._cond=threading.Condition()
+    def is_running(self):
+        return self._running
+    def start(self):
+        if self._running:
+            return
+        if self.pipeline is None:
+            self.pipeline,self.config,self.align=self.factory()
+        self.pipeline.start(self.config)
+        self._running=True
+        self._thread=threading.Thread(target=self._capture_loop,name="realsense-capture",daemon=True)
+        self._thread.start()
+    def stop(self):
+        if not self._running:
+            return
+        self._running=False
+        self._thread.join()
+        self._thread=None
+        self.pipeline.stop()
+        with self._cond:
+            self._info=[None]*self.ring_size
+            self._newest=-1
+            self._cond.notify_all()
+    """
+    Copy of the newest aligned pair
+    newer_than: host time(s), wait until a pair captured after it arrives
+    (ex: the time of the request, so the frame is not taken before the robot stopped)
+    """
+    def latest(self,newer_than=None,timeout=2.0):
+        deadline=time.time()+timeout
+        # capture: waiting for the new frame + copying it out
+        with span('capture'),self._cond:
+            while True:
+                if self._newest>=0:
+                    info=self._info[self._newest]
+                    if newer_than is None or info[2]>=newer_than:
+                        return self._copy(self._newest)
+                remain=deadline-time.time()
+                if not self._running or remain<=0:
+                    message="No frame from the realsense camera, check start_stream."
+                    if self.last_error is not None:
+                        message+=" Last capture error: %s" % self.last_error
+                    raise Exception(message)
+                self._cond.wait(remain)
+    # copy of the buffered pair closest to host_time(s), ex: the time of a 6dof pose
+    def closest(self,host_time):
+        with self._cond:
+            slots=[i for i in range(self.ring_size) if self._info[i] is not None]
+            if not slots:
+                raise Exception("No frame from the realsense camera, check start_stream.")
+            slot=min(slots,key=lambda i: abs(self._info[i][2]-host_time))
+            return self._copy(slot)
+    def _copy(self,slot):
+        frame_number,timestamp,host_time=self._info[slot]
+        return RGBDFrame(self._colors[slot].copy(),self._depths[slot].copy(),frame_number,timestamp,host_time)
+    # any error of one frame is logged and the thread goes on, so latest() never waits on a dead thread
+    def _capture_loop(self):
+        while self._running:
+            try:
+                self._capture_once()
+            except Exception as e:
+                print("realsense capture: ",repr(e))
+                self.last_error=repr(e)
+                # do not spin when the camera keeps failing
+                time.sleep(0.01)
+    def _capture_once(self):
+        frames=self.pipeline.wait_for_frames()
+        host_time=time.time()
+        with span('align'):
+            # Align the depth frame to color frame
+            aligned_frames=self.align.process(frames)
+            depth_frame=aligned_frames.get_depth_frame()
+            color_frame=aligned_frames.get_color_frame()
+            # Validate that both frames are valid
+            if not depth_frame or not color_frame:
+                return
+            depth_image=np.asanyarray(depth_frame.get_data())
+            color_image=np.asanyarray(color_frame.get_data())
+        with self._cond:
+            if self._colors is None or self._colors.shape[1:]!=color_image.shape or self._depths.shape[1:]!=depth_image.shape:
+                self._colors=np.empty((self.ring_size,)+color_image.shape,dtype=color_image.dtype)
+                self._depths=np.empty((self.ring_size,)+depth_image.shape,dtype=depth_image.dtype)
+                self._info=[None]*self.ring_size
+                self._newest=-1
+            slot=(self._newest+1)%self.ring_size
+            self._colors[slot]=color_image
+            self._depths[slot]=depth_image
+            self._info[slot]=(frames.get_frame_number(),frames.get_timestamp(),host_time)
+            self._newest=slot
+            self._cond.notify_all()
@@ -0,0 +1,64 @@
+"""
+Shared-memory frame ring between the flask server and the MaskRCNN worker process.
+Every slot holds one rgb frame (H,W,3) uint8 and one mask (H,W) uint8, so frames and
+masks move between the processes without pickling them through the pipe.
+Ownership of a slot:
+1. server: slot=ring.acquire()        -> the slot belongs to the server
+2. server writes ring.image_view(slot) and sends the slot index to the worker
+3. worker reads the image, writes ring.mask_view(slot) and replies -> back to the server
+4. server reads the mask and calls ring.release(slot), the slot can be reused
+Only the process which created the ring (create=True) owns the free list and unlinks it.
+"""
+import queue
+import numpy as np
+from multiprocessing import shared_memory
+
+class SharedFrameRing():
+    def __init__(self,slots=4,height=480,width=640,name=None,create=True):
+        self.slots=slots
+        self.height=height
+        self.width=width
+        self.image_size=height*width*3
+        self.slot_size=self.image_size+height*width
+        self.owner=create
+        if create:
+            self.shm=shared_memory.SharedMemory(name=name,create=True,size=slots*self.slot_size)
+            self._free=queue.Queue()
+            for slot in range(slots):
+                self._free.put(slot)
+        else:
+            # the worker is spawned by the owner and shares its resource tracker,
+            # so the segment is still unlinked only once by the owner
+            self.shm=shared_memory.SharedMemory(name=name)
+            self._free=None
+        self.name=self.shm.name
+        buffer=np.ndarray((slots,self.slot_size),dtype=np.uint8,buffer=self.shm.buf)
+        self._images=buffer[:,:self.image_size].reshape(slots,height,width,3)
+        self._masks=buffer[:,self.image_size:].reshape(slots,height,width)
+    # attach to a ring created by another process
+    @classmethod
+    def attach(cls,name,slots,height,width):
+        return cls(slots=slots,height=height,width=width,name=name,create=False)
+    # everything the other process needs for attach()
+    def spec(self):
+        return (self.name,self.slots,self.height,self.width)
+    def fits(self,image):
+        return image.shape==(self.height,self.width,3)
+    def image_view(self,slot):
+        return self._images[slot]
+    def mask_view(self,slot):
+        return self._masks[slot]
+    # block until a slot is free, raise queue.Empty after timeout
+    def acquire(self,timeout=None):
+        if not self.owner:
+            raise Exception("Only the process which creates the ring can acquire slots.")
+        return self._free.get(timeout=timeout)
+    def release(self,slot):
+        self._free.put(slot)
+    def close(self):
+        self._images=None
+        self._masks=None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
@@ -0,0 +1,190 @@
+"""
+Masked TSDF fusion for the 3D reconstruction of the target object
+Every view(color, depth, MaskRCNN mask, camera->base pose) is integrated into a bounded voxel
+volume of truncated signed distances. Only the voxels which project into the mask of the
+object(the mask frustum) are updated, so the table and the other objects never enter the
+volume. The whole view is done at once with numpy: all voxels are projected into the image,
+there is no loop over the pixels or the voxels.
+The surface can be extracted at any time as a point cloud(zero crossings of the tsdf) or as a
+mesh(marching cubes, needs scikit-image).
+pose: camera->base 4x4 (unit: meter), ex: forward_kinematic(6dof) with the translation in
+meter, dot HAND_EYE_TFMATRIX, which is CURRENT_POSTION in restapi_server_rgbd.py
+EX:
+volume=MaskedTSDFVolume(voxel_size=0.002,extent=0.3)
+volume.integrate(color,depth,mask,pose,camera)    # rgb color, raw depth, mask or CompactMask
+xyz_points,rgb_points=volume.extract_points()
+vertices,faces,colors=volume.extract_mesh()
+"""
+import numpy as np
+from Utils.compact_mask import CompactMask
+from Utils.point_cloud_tool import backproject_masked_rgbd
+
+class MaskedTSDFVolume():
+    """
+    bounds: [[xmin,xmax],[ymin,ymax],[zmin,zmax]] in base frame(meter)
+    If bounds is None, the volume is a cube of side extent centered at the masked points of
+    the first view.
+    truncation: default 5 voxels
+    """
+    def __init__(self,bounds=None,voxel_size=0.002,extent=0.3,truncation=None,max_weight=64):
+        self.voxel_size=float(voxel_size)
+        self.extent=float(extent)
+        self.truncation=float(truncation) if truncation is not None else 5*self.voxel_size
+        self.max_weight=max_weight
+        self.bounds=None
+        self.integrated_views=0
+        if bounds is not None:
+            self._allocate(np.asarray(bounds,dtype=np.float64))
+    def is_empty(self):
+        return self.bounds is None or self.integrated_views==0
+    def clear(self):
+        self.bounds=None
+        self.integrated_views=0
+        self.tsdf=self.weight=self.color=None
+    def _allocate(self,bounds):
+        self.shape=tuple(int(n) for n in np.ceil((bounds[:,1]-bounds[:,0])/self.voxel_size))
+        self.origin=bounds[:,0].astype(np.float64)
+        self.bounds=bounds
+        self.tsdf=np.ones(self.shape,dtype=np.float32)
+        self.weight=np.zeros(self.shape,dtype=np.float32)
+        self.color=np.zeros(self.shape+(3,),dtype=np.float32)
+    """
+    Integrate one view
+    color: (H,W,3) rgb, depth: (H,W) raw depth, mask: (H,W) or CompactMask
+    return: number of voxels updated
+    """
+    def integrate(self,color,depth,mask,pose,camera):
+        pose=np.asarray(pose,dtype=np.float64)
+        if self.bounds is None:
+            xyz_points,rgb_points=backproject_masked_rgbd(color,depth,mask,camera)
+            if len(xyz_points)==0:
+                return 0
+            center=xyz_points.astype(np.float64).dot(pose[0:3,0:3].T).mean(axis=0)+pose[0:3,3]
+            half=self.extent/2
+            self._allocate(np.stack([center-half,center+half],axis=1))
+        color=np.asarray(color)
+        depth=np.asarray(depth)
+        height,width=depth.shape
+        if isinstance(mask,CompactMask):
+            y1,x1,y2,x2=mask.bbox
+            mask_crop=mask.crop()
+        else:
+            mask=np.asarray(mask)!=0
+            rows=np.flatnonzero(mask.any(axis=1))
+            cols=np.flatnonzero(mask.any(axis=0))
+            if len(rows)==0:
+                return 0
+            y1,y2,x1,x2=rows[0],rows[-1]+1,cols[0],cols[-1]+1
+            mask_crop=mask[y1:y2,x1:x2]
+        if mask_crop.size==0:
+            return 0
+        # voxel centers in camera frame: R^T*(p-t), the grid is regular so it is separable
+        rotation=pose[0:3,0:3].T
+        start=rotation.dot(self.origin+0.5*self.voxel_size-pose[0:3,3])
+        steps=rotation*self.voxel_size
+        i=np.arange(self.shape[0],dtype=np.float32)[:,None,None]
+        j=np.arange(self.shape[1],dtype=np.float32)[None,:,None]
+        k=np.arange(self.shape[2],dtype=np.float32)[None,None,:]
+        def camera_axis(axis):
+            s=steps[axis].astype(np.float32)
+            return (np.float32(start[axis])+i*s[0]+j*s[1]+k*s[2]).reshape(-1)
+        # project every voxel(float32, int32), then cull with the mask bbox and the mask itself
+        z=camera_axis(2)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            inverse_z=np.float32(1)/z
+            u=camera_axis(0)*inverse_z
+            u*=np.float32(camera.fx)
+            u+=np.float32(camera.cx+0.5)
+            v=camera_axis(1)*inverse_z
+            v*=np.float32(camera.fy)
+            v+=np.float32(camera.cy+0.5)
+        inside=(z>1e-6)&(u>=max(x1,0))&(u<min(x2,width))&(v>=max(y1,0))&(v<min(y2,height))
+        candidates=np.flatnonzero(inside)
+        z=z[candidates]
+        u=u[candidates].astype(np.int32)
+        v=v[candidates].astype(np.int32)
+        inside=mask_crop[v-y1,u-x1]
+        candidates,z,u,v=candidates[inside],z[inside],u[inside],v[inside]
+        # signed distance along the ray, only the voxels in front of/near the surface
+        surface=depth[v,u].astype(np.float32)*np.float32(camera.scalingfactor)
+        sdf=surface-z
+        valid=(surface>0)&(sdf>=-self.truncation)
+        candidates,u,v,sdf=candidates[valid],u[valid],v[valid],sdf[valid]
+        tsdf_new=np.minimum(1.0,sdf/self.truncation)
+        # running weighted average
+        tsdf=self.tsdf.reshape(-1)
+        weight=self.weight.reshape(-1)
+        voxel_color=self.color.reshape(-1,3)
+        old_weight=weight[candidates]
+        new_weight=old_weight+1
+        tsdf[candidates]=(tsdf[candidates]*old_weight+tsdf_new)/new_weight
+        voxel_color[candidates]=(voxel_color[candidates]*old_weight[:,None]+color[v,u])/new_weight[:,None]
+        weight[candidates]=np.minimum(new_weight,self.max_weight)
+        self.integrated_views+=1
+        return len(candidates)
+    """
+    Surface point cloud: the zero crossings of the tsdf between neighbouring observed voxels
+    return: xyz (N,3) float32 in base frame, rgb (N,3) uint8
+    """
+    def extract_points(self):
+        if self.is_empty():
+            return np.empty((0,3),dtype=np.float32),np.empty((0,3),dtype=np.uint8)
+        xyz_list=[]
+        rgb_list=[]
+        observed=self.weight>0
+        for axis in range(3):
+            head=[slice(None)]*3
+            tail=[slice(None)]*3
+            head[axis]=slice(None,-1)
+            tail[axis]=slice(1,None)
+            head,tail=tuple(head),tuple(tail)
+            tsdf0,tsdf1=self.tsdf[head],self.tsdf[tail]
+            # both sides inside the truncation band, otherwise it is the edge of the observed space
+            crossing=observed[head]&observed[tail]&((tsdf0>0)!=(tsdf1>0))&(np.abs(tsdf0)<1)&(np.abs(tsdf1)<1)
+            index=np.argwhere(crossing)
+            t0,t1=tsdf0[crossing],tsdf1[crossing]
+            ratio=(t0/(t0-t1))[:,None]
+            position=index.astype(np.float32)
+            position[:,axis]+=ratio[:,0]
+            xyz_list.append((self.origin+(position+0.5)*self.voxel_size).astype(np.float32))
+            c0,c1=self.color[head][crossing],self.color[tail][crossing]
+            rgb_list.append(np.rint(c0+(c1-c0)*ratio).astype(np.uint8))
+        return np.concatenate(xyz_list),np.concatenate(rgb_list)
+    """
+    Mesh of the surface with marching cubes(scikit-image)
+    return: vertices (V,3) float32 in base frame, faces (F,3) int, colors (V,3) uint8
+    """
+    def extract_mesh(self):
+        try:
+            from skimage import measure
+        except ImportError:
+            raise Exception("extract_mesh needs scikit-image, pip install scikit-image")
+        if self.is_empty():
+            raise Exception("The TSDF volume is empty.")
+        # requirements.txt pins scikit-image 0.15(marching_cubes_lewiner), 0.19 removed it for marching_cubes
+        marching_cubes=getattr(measure,'marching_cubes_lewiner',None) or measure.marching_cubes
+        vertices,faces,normals,values=marching_cubes(self.tsdf,0,mask=self.weight>0)
+        index=np.clip(np.rint(vertices).astype(np.int64),0,np.array(self.shape)-1)
+        colors=np.rint(self.color[index[:,0],index[:,1],index[:,2]]).astype(np.uint8)
+        vertices=(self.origin+(vertices+0.5)*self.voxel_size).astype(np.float32)
+        return vertices,faces,colors
+
+# binary ply with vertex colors and faces, ex: the output of extract_mesh
+def save_mesh_to_ply(path,vertices,faces,colors):
+    vertex=np.empty(len(vertices),dtype=[('x','<f4'),('y','<f4'),('z','<f4'),('red','u1'),('green','u1'),('blue','u1')])
+    vertex['x'],vertex['y'],vertex['z']=vertices[:,0],vertices[:,1],vertices[:,2]
+    vertex['red'],vertex['green'],vertex['blue']=colors[:,0],colors[:,1],colors[:,2]
+    face=np.empty(len(faces),dtype=[('count','u1'),('index','<i4',(3,))])
+    face['count']=3
+    face['index']=faces
+    header=("ply\nformat binary_little_endian 1.0\n"
+            "element vertex %d\n"
+            "property float x\nproperty float y\nproperty float z\n"
+            "property uchar red\nproperty uchar green\nproperty uchar blue\n"
+            "element face %d\n"
+            "property list uchar int vertex_indices\n"
+            "end_header\n") % (len(vertex),len(face))
+    with open(path,'wb') as file:
+        file.write(header.encode('ascii'))
+        vertex.tofile(file)
+        face.tofile(file)
@@ -0,0 +1,88 @@
+"""
+Incremental voxel-hashed point cloud
+Every view is integrated into a sparse voxel hash(dict: voxel key -> slot) which keeps the
+running sum of the xyz and the rgb and the number of points of each voxel, so the fused cloud
+is already deduplicated (one point per voxel: the centroid and the mean color) and there is no
+need for a voxel down sampling pass through open3d afterwards.
+The slots are preallocated for max_voxels voxels, so the memory is bounded. Points falling
+into new voxels after the accumulator is full are dropped(and counted in dropped_points).
+EX:
+accumulator=VoxelHashAccumulator(voxel_size=0.002)
+accumulator.integrate(xyz_points,rgb_points)     # (N,3) base frame, (N,3) uint8
+xyz_points,rgb_points=accumulator.snapshot()     # centroids float32, mean colors uint8
+"""
+import threading
+import numpy as np
+
+# 21 bits per axis in one int64 key, voxel index in [-2^20,2^20)
+KEY_BITS=21
+KEY_OFFSET=1<<(KEY_BITS-1)
+
+class VoxelHashAccumulator():
+    def __init__(self,voxel_size=0.002,max_voxels=500000):
+        self.voxel_size=float(voxel_size)
+        self.max_voxels=max_voxels
+        self._table={}
+        self._xyz_sum=np.zeros((max_voxels,3),dtype=np.float64)
+        self._rgb_sum=np.zeros((max_voxels,3),dtype=np.uint32)
+        self._counts=np.zeros(max_voxels,dtype=np.int64)
+        self._size=0
+        self.dropped_points=0
+        self._lock=threading.Lock()
+    def __len__(self):
+        return self._size
+    def voxel_keys(self,xyz_points):
+        voxel=np.floor(np.asarray(xyz_points,dtype=np.float64)/self.voxel_size).astype(np.int64)+KEY_OFFSET
+        if len(voxel) and (voxel.min()<0 or voxel.max()>=(1<<KEY_BITS)):
+            raise Exception("Points are too far away for the voxel size %f." % self.voxel_size)
+        return (voxel[:,0]<<(2*KEY_BITS))|(voxel[:,1]<<KEY_BITS)|voxel[:,2]
+    """
+    Add one view(or any points) to the running voxels
+    xyz_points: (N,3), rgb_points: (N,3) uint8
+    return: number of points which were integrated
+    """
+    def integrate(self,xyz_points,rgb_points):
+        xyz_points=np.asarray(xyz_points)
+        rgb_points=np.asarray(rgb_points)
+        if len(xyz_points)==0:
+            return 0
+        keys,inverse=np.unique(self.voxel_keys(xyz_points),return_inverse=True)
+        inverse=inverse.reshape(-1)
+        with self._lock:
+            # one dict lookup per voxel of the view
+            table=self._table
+            slots=np.fromiter((table.get(key,-1) for key in keys.tolist()),dtype=np.int64,count=len(keys))
+            new=np.flatnonzero(slots<0)
+            room=min(len(new),self.max_voxels-self._size)
+            if room>0:
+                new_slots=np.arange(self._size,self._size+room)
+                slots[new[:room]]=new_slots
+                table.update(zip(keys[new[:room]].tolist(),new_slots.tolist()))
+                self._size+=room
+            # sums per voxel of the view(bincount over the view only, not over all the slots so far)
+            # bincount is much faster than np.add.at, the slots of a view are unique
+            counts=np.bincount(inverse,minlength=len(keys))
+            keep=slots>=0
+            if not keep.all():
+                self.dropped_points+=int(counts[~keep].sum())
+            used=slots[keep]
+            for axis in range(3):
+                self._xyz_sum[used,axis]+=np.bincount(inverse,weights=xyz_points[:,axis],minlength=len(keys))[keep]
+                self._rgb_sum[used,axis]+=np.bincount(inverse,weights=rgb_points[:,axis],minlength=len(keys))[keep].astype(np.uint32)
+            self._counts[used]+=counts[keep]
+        return int(counts[keep].sum())
+    # (M,3) float32 voxel centroids and (M,3) uint8 mean colors, copies
+    def snapshot(self):
+        with self._lock:
+            counts=self._counts[:self._size,np.newaxis]
+            xyz_points=(self._xyz_sum[:self._size]/counts).astype(np.float32)
+            rgb_points=np.rint(self._rgb_sum[:self._size]/counts).astype(np.uint8)
+        return xyz_points,rgb_points
+    def clear(self):
+        with self._lock:
+            self._table={}
+            self._xyz_sum[:self._size]=0
+            self._rgb_sum[:self._size]=0
+            self._counts[:self._size]=0
+            self._size=0
+            self.dropped_points=0
@@ -60,6 +60,54 @@ def forward_kinematic(six_dof_dic):
     return t0_6
 
 # ======================================================
+# Batched FK
+# ======================================================
+"""
+DH table of RA605 without the joint values, unit mm
+[alpha, a, theta offset, d] for j1~j6 (same as forward_kinematic)
+"""
+DH_PARAMS=np.array([
+    [-math.pi/2,30,0,375],
+    [0,340,-math.pi/2,0],
+    [-math.pi/2,40,0,0],
+    [math.pi/2,0,0,338],
+    [-math.pi/2,0,0,0],
+    [0,0,0,86]
+])
+# t_matrix for an array of theta, return (N,4,4)
+def t_matrix_batch(theta,d,a,alpha):
+    cos_t=np.cos(theta)
+    sin_t=np.sin(theta)
+    output=np.zeros((len(theta),4,4))
+    output[:,0,0]=cos_t
+    output[:,0,1]=-sin_t*math.cos(alpha)
+    output[:,0,2]=sin_t*math.sin(alpha)
+    output[:,0,3]=a*cos_t
+    output[:,1,0]=sin_t
+    output[:,1,1]=cos_t*math.cos(alpha)
+    output[:,1,2]=-cos_t*math.sin(alpha)
+    output[:,1,3]=a*sin_t
+    output[:,2,1]=math.sin(alpha)
+    output[:,2,2]=math.cos(alpha)
+    output[:,2,3]=d
+    output[:,3,3]=1
+    return output
+"""
+input: (N,6) array-like of joint angles in degree, columns are j1~j6
+return: (N,4,4) nparray, row i is forward_kinematic of joints[i]
+The input is not modified.
+"""
+def forward_kinematic_batch(joints):
+    joints=np.asarray(joints,dtype=np.float64)
+    if joints.ndim!=2 or joints.shape[1]!=6:
+        raise Exception("joints should be a (N,6) array of j1~j6 in degree.")
+    theta=np.radians(joints)+DH_PARAMS[:,2]
+    t0_6=np.broadcast_to(np.eye(4),(len(joints),4,4))
+    for i in range(len(DH_PARAMS)):
+        alpha,a,_,d=DH_PARAMS[i]
+        t0_6=np.matmul(t0_6,t_matrix_batch(theta[:,i],d,a,alpha))
+    return t0_6
+# ======================================================
 # ik parameter setting up
 l5=86
 l4=338
@@ -146,6 +194,91 @@ def inverse_kinematic(t0_6):
         'j6':theta6/math.pi*180,
     }
     return six_dof_dic
+# ======================================================
+# Batched IK
+# ======================================================
+"""
+input:
+t0_6: (N,4,4) array of target transformation matrices(unit mm)
+joint_limits: optional (6,2) array of [min,max] in degree, branches out of limits are invalid
+return:
+solutions: (N,8,6) joint angles in degree (wrapped to -180~180), branch k is
+    shoulder=k//4 (0: front, 1: back), elbow=(k//2)%2 (0: up, 1: down), wrist=k%2 (0: j5>=0, 1: j5<=0)
+valid: (N,8) bool, False if the wrist center is out of reach(no math.acos error anymore) or out of joint limits
+No message is printed, use closest_ik_solution to pick one branch per target.
+"""
+def inverse_kinematic_batch(t0_6,joint_limits=None):
+    t0_6=np.asarray(t0_6,dtype=np.float64)
+    if t0_6.ndim!=3 or t0_6.shape[1:]!=(4,4):
+        raise Exception("t0_6 should be a (N,4,4) array of transformation matrices.")
+    num=len(t0_6)
+    solutions=np.zeros((num,8,6))
+    valid=np.zeros((num,8),dtype=bool)
+    # wrist center
+    wrist=t0_6[:,0:3,3]-l5*t0_6[:,0:3,2]
+    r0_6=t0_6[:,0:3,0:3]
+    theta3_5=math.atan2(l4,l3)
+    front_theta1=np.arctan2(wrist[:,1],wrist[:,0])
+    for shoulder in range(2):
+        theta1=front_theta1+shoulder*math.pi
+        # position of the wrist center seen from joint 2 in the arm plane
+        x_prime=wrist[:,0]*np.cos(theta1)+wrist[:,1]*np.sin(theta1)-l1
+        z_prime=wrist[:,2]-l0
+        cos_theta=(l3_5**2+l2**2-x_prime**2-z_prime**2)/(2*l3_5*l2)
+        reachable=np.abs(cos_theta)<=1+1e-9
+        for elbow in range(2):
+            theta=np.arccos(np.clip(cos_theta,-1,1))
+            if elbow==1:
+                theta=-theta
+            theta3=math.pi-theta3_5-theta
+            a=l2-l3_5*np.cos(theta)
+            b=l3_5*np.sin(theta)
+            theta2=np.arctan2(a*x_prime-b*z_prime,a*z_prime+b*x_prime)
+            t0_3=np.broadcast_to(np.eye(4),(num,4,4))
+            for i,joint in enumerate((theta1,theta2,theta3)):
+                alpha,a_i,offset,d=DH_PARAMS[i]
+                t0_3=np.matmul(t0_3,t_matrix_batch(joint+offset,d,a_i,alpha))
+            r3_6=np.matmul(np.transpose(t0_3[:,0:3,0:3],(0,2,1)),r0_6)
+            wrists=_wrist_branches(r3_6)
+            for wrist_branch,(theta4,theta5,theta6) in enumerate(wrists):
+                k=shoulder*4+elbow*2+wrist_branch
+                solutions[:,k]=np.degrees(np.stack([theta1,theta2,theta3,theta4,theta5,theta6],axis=1))
+                valid[:,k]=reachable
+    solutions=(solutions+180)%360-180
+    if joint_limits is not None:
+        joint_limits=np.asarray(joint_limits,dtype=np.float64)
+        valid&=np.all((solutions>=joint_limits[:,0]-1e-9)&(solutions<=joint_limits[:,1]+1e-9),axis=2)
+    return solutions,valid
+# two wrist branches from r3_6, j5=0 or 180 is singular so j4 is set to 0
+def _wrist_branches(r3_6):
+    cos_theta5=np.clip(r3_6[:,2,2],-1,1)
+    singular=(r3_6[:,2,0]**2+r3_6[:,2,1]**2)<1e-12
+    theta5=np.arccos(cos_theta5)
+    branches=[
+        [np.arctan2(-r3_6[:,1,2],-r3_6[:,0,2]),theta5,np.arctan2(-r3_6[:,2,1],r3_6[:,2,0])],
+        [np.arctan2(r3_6[:,1,2],r3_6[:,0,2]),-theta5,np.arctan2(r3_6[:,2,1],-r3_6[:,2,0])]
+    ]
+    if np.any(singular):
+        flipped=cos_theta5<0
+        theta5_s=np.where(flipped,math.pi,0.0)
+        theta6_s=np.where(flipped,np.arctan2(r3_6[:,1,0],r3_6[:,1,1]),np.arctan2(r3_6[:,1,0],r3_6[:,0,0]))
+        for branch in branches:
+            branch[0]=np.where(singular,0.0,branch[0])
+            branch[1]=np.where(singular,theta5_s,branch[1])
+            branch[2]=np.where(singular,theta6_s,branch[2])
+    return branches
+"""
+Pick the valid branch closest to the seed configuration(ex: the current joints of the robot)
+seed: (6,) or (N,6) in degree
+return: (N,6) joint angles in degree, (N,) bool True if any branch was valid
+"""
+def closest_ik_solution(solutions,valid,seed):
+    seed=np.broadcast_to(np.asarray(seed,dtype=np.float64),(len(solutions),6))
+    difference=(solutions-seed[:,np.newaxis,:]+180)%360-180
+    cost=np.sum(difference**2,axis=2)
+    cost[~valid]=np.inf
+    best=np.argmin(cost,axis=1)
+    return solutions[np.arange(len(solutions)),best],valid.any(axis=1)
 # ===============================================================
 if __name__=='__main__':
     print("testing....")
@@ -188,4 +321,16 @@ if __name__=='__main__':
     print('ik transformation matrix:\n', str(np.around(t0_6_ik,4)))
     # with all colse method, we can tolerate some difference btw them.
     print('-'*20)
-    print('Is t0_6 equal to t0_6_ik?: ',np.allclose(t0_6,t0_6_ik))
\ No newline at end of file
+    print('Is t0_6 equal to t0_6_ik?: ',np.allclose(t0_6,t0_6_ik))
+    # batched fk should give the same result as the scalar one
+    print('-'*20)
+    joints=np.random.uniform(-180,180,(20,6))
+    t0_6_batch=forward_kinematic_batch(joints)
+    t0_6_scalar=np.array([forward_kinematic(dict(zip(['j1','j2','j3','j4','j5','j6'],row))) for row in joints.tolist()])
+    print('Is batch fk equal to fk?: ',np.allclose(t0_6_batch,t0_6_scalar))
+    # every valid branch of the batched ik should go back to the same pose
+    solutions,valid=inverse_kinematic_batch(t0_6_batch)
+    t0_6_branches=forward_kinematic_batch(solutions.reshape(-1,6)).reshape(-1,8,4,4)
+    print('Are all ik branches correct?: ',np.allclose(t0_6_branches[valid],np.repeat(t0_6_batch[:,np.newaxis],8,axis=1)[valid]))
+    best,found=closest_ik_solution(solutions,valid,joints)
+    print('Does the closest branch give back the joints?: ',np.allclose((best-joints+180)%360-180,0,atol=1e-6))
\ No newline at end of file
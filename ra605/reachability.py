@@ -0,0 +1,118 @@
+"""
+Reachability map of the RA605
+Sweep the joint space with forward_kinematic_batch and mark every voxel of the workspace
+which the flange can reach, together with the approach directions(z axis of t0_6) it can
+reach with. Then "is this grasp reachable" is one lookup, so bad PCA grasp candidates
+can be rejected before paying for the IK.
+
+file format(path without extension):
+path.npy : (X,Y,Z) uint32 grid, bit k is set if approach direction bin k is reachable
+path.json: origin, voxel size and direction bins of the grid
+The grid is loaded with mmap, so loading at server start is almost free.
+
+Build the map once (from the root of this repo):
+python -m ra605.reachability
+Use it:
+reachability=ReachabilityMap.load(REACHABILITY_MAP_PATH)
+reachability.is_reachable(t0_6)   # 4x4 pose, unit mm (same as forward_kinematic)
+"""
+import json
+import math
+import os
+import numpy as np
+from ra605.arm_kinematic import forward_kinematic_batch
+
+# joint limits of the RA605 in degree(check them with your own controller)
+JOINT_LIMITS=np.array([
+    [-165,165],
+    [-125,85],
+    [-55,185],
+    [-190,190],
+    [-115,115],
+    [-360,360]
+])
+REACHABILITY_MAP_PATH=os.path.join(os.path.abspath(os.path.dirname(__file__)),"ra605_reachability")
+# the approach directions are binned by polar and azimuth angle, 4*8=32 bins in one uint32
+POLAR_BINS=4
+AZIMUTH_BINS=8
+
+class ReachabilityMap():
+    def __init__(self,grid,origin,voxel_size,polar_bins=POLAR_BINS,azimuth_bins=AZIMUTH_BINS):
+        self.grid=grid
+        self.origin=np.asarray(origin,dtype=np.float64)
+        self.voxel_size=float(voxel_size)
+        self.polar_bins=polar_bins
+        self.azimuth_bins=azimuth_bins
+        self.shape=np.array(grid.shape)
+    """
+    Sweep the joint space
+    bounds: [[xmin,xmax],[ymin,ymax],[zmin,zmax]] in mm
+    num_samples: random joint configurations(uniform within joint_limits)
+    Voxels which are never hit stay unreachable, so use enough samples for your voxel size.
+    """
+    @classmethod
+    def build(cls,bounds=((-900,900),(-900,900),(-400,1200)),voxel_size=20,num_samples=5000000,
+              joint_limits=JOINT_LIMITS,chunk_size=200000,seed=0):
+        bounds=np.asarray(bounds,dtype=np.float64)
+        shape=np.ceil((bounds[:,1]-bounds[:,0])/voxel_size).astype(int)
+        reachability=cls(np.zeros(tuple(shape),dtype=np.uint32),bounds[:,0],voxel_size)
+        flat_grid=reachability.grid.reshape(-1)
+        joint_limits=np.asarray(joint_limits,dtype=np.float64)
+        rng=np.random.RandomState(seed)
+        for start in range(0,num_samples,chunk_size):
+            count=min(chunk_size,num_samples-start)
+            joints=rng.uniform(joint_limits[:,0],joint_limits[:,1],(count,6))
+            t0_6=forward_kinematic_batch(joints)
+            index,inside=reachability._voxel_index(t0_6[:,0:3,3])
+            bits=reachability._direction_bits(t0_6[:,0:3,2])
+            np.bitwise_or.at(flat_grid,index[inside],bits[inside])
+            print("reachability map: %d/%d samples" % (start+count,num_samples))
+        return reachability
+    def save(self,path=REACHABILITY_MAP_PATH):
+        np.save(path+".npy",np.ascontiguousarray(self.grid))
+        with open(path+".json","w") as file:
+            json.dump({
+                'origin':self.origin.tolist(),
+                'voxel_size':self.voxel_size,
+                'polar_bins':self.polar_bins,
+                'azimuth_bins':self.azimuth_bins
+            },file)
+    @classmethod
+    def load(cls,path=REACHABILITY_MAP_PATH):
+        with open(path+".json","r") as file:
+            meta=json.load(file)
+        grid=np.load(path+".npy",mmap_mode='r')
+        return cls(grid,meta['origin'],meta['voxel_size'],meta['polar_bins'],meta['azimuth_bins'])
+    # is a single 4x4 pose(unit mm) reachable with its approach direction
+    def is_reachable(self,t0_6):
+        return bool(self.query(np.asarray(t0_6)[np.newaxis])[0])
+    """
+    (N,4,4) poses -> (N,) bool
+    check_direction=False only checks whether the position can be reached at all
+    """
+    def query(self,t0_6,check_direction=True):
+        t0_6=np.asarray(t0_6,dtype=np.float64)
+        index,inside=self._voxel_index(t0_6[:,0:3,3])
+        cells=np.zeros(len(t0_6),dtype=np.uint32)
+        cells[inside]=self.grid.reshape(-1)[index[inside]]
+        if not check_direction:
+            return cells!=0
+        return (cells&self._direction_bits(t0_6[:,0:3,2]))!=0
+    def _voxel_index(self,positions):
+        voxel=np.floor((positions-self.origin)/self.voxel_size).astype(np.int64)
+        inside=np.all((voxel>=0)&(voxel<self.shape),axis=1)
+        voxel=np.clip(voxel,0,self.shape-1)
+        return np.ravel_multi_index(voxel.T,tuple(self.shape)),inside
+    def _direction_bits(self,directions):
+        directions=directions/np.linalg.norm(directions,axis=1,keepdims=True)
+        polar=np.arccos(np.clip(directions[:,2],-1,1))
+        azimuth=np.arctan2(directions[:,1],directions[:,0])+math.pi
+        polar_bin=np.minimum((polar/math.pi*self.polar_bins).astype(np.int64),self.polar_bins-1)
+        azimuth_bin=np.minimum((azimuth/(2*math.pi)*self.azimuth_bins).astype(np.int64),self.azimuth_bins-1)
+        return np.left_shift(np.uint32(1),(polar_bin*self.azimuth_bins+azimuth_bin).astype(np.uint32))
+
+if __name__=='__main__':
+    reachability=ReachabilityMap.build()
+    reachability.save()
+    print("reachable voxels: %d / %d" % (np.count_nonzero(reachability.grid),reachability.grid.size))
+    print("saved in: ",REACHABILITY_MAP_PATH)
@@ -2,11 +2,14 @@ from flask import Flask, jsonify
 from flask import make_response
 from flask import request
 from flask import abort
+from flask import Response
 import os
 import cv2
 import time
 import json
 from ra605.arm_kinematic import *
+from Utils.action_router import ActionRouter
+from Utils.metrics import METRICS,span
 app = Flask(__name__)
 cap = cv2.VideoCapture(0)
 # =================================================================
@@ -148,63 +151,90 @@ def delete_task(task_id):
 # ============================================================================
 # 控制器希望PC這邊做甚麼事情
 # Action controller
+# 每個action都是註冊在ROUTER裡的function (Utils/action_router.py)
+# 在url後面加上 ?async=1 就會馬上回傳job_id，之後用 /todo/api/v1.0/jobs/<job_id> 查詢結果
+ROUTER=ActionRouter()
+def run_action(action_name,action_parameter=None):
+    if not ROUTER.has_action(action_name,action_parameter is not None):
+        abort(404)
+    if request.args.get('async'):
+        job_id=ROUTER.submit(action_name,action_parameter)
+        return jsonify({'msg': "Submitted",'job_id': job_id}),202
+    return jsonify(ROUTER.dispatch(action_name,action_parameter))
 # 純粹希望pc端坐事情的 可以使用action name傳遞 注意後面的/不能夠省略
 @app.route('/todo/api/v1.0/actions/<string:action_name>/', methods=['GET'])
 def take_action(action_name):
-    global count
     print("url: '/todo/api/v1.0/actions/<string:action_name>'")
-    if action_name==None:
-        abort(404)
-    # 新增action name即可
-    elif action_name=="show_list":
-        count+=1
-        print(count)
-        json_string={
-            'msg': pose_list
-        }
-        return jsonify(json_string)
-    elif action_name=="sayhi":
-        return jsonify(prediction)
-    else:
-        abort(404)
+    return run_action(action_name)
 """
 這裡面的寫法必須注意的事情有：
 1.要進來這個route就是必須傳遞parameter，否則會走上面那個路徑
 labview端就不需要傳參數給action parameter
-2.新增方法的話只要新增elif的條件判斷即可，action parameter就是對應的參數
+2.新增方法的話只要用ROUTER.action(..., parameter=True)註冊即可，action parameter就是對應的參數
 """
 @app.route('/todo/api/v1.0/actions/<string:action_name>/<string:action_parameter>', methods=['GET'])
 def take_action_with_parameter(action_name,action_parameter):
-    global cap
+    # 基本上 裡面可以用來處理任何邏輯運算 以及需要執行甚麼動作
+    print(action_name,action_parameter)
+    return run_action(action_name,action_parameter)
+# 查詢 ?async=1 送出的action
+@app.route('/todo/api/v1.0/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    job=ROUTER.job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify({'job': job})
+# 每個stage的latency (Utils/metrics.py)，/metrics 給Prometheus抓, metrics_summary/ 是json版
+METRICS_ENABLED=True
+METRICS.enabled=METRICS_ENABLED
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(METRICS.prometheus_text(),content_type='text/plain; version=0.0.4; charset=utf-8')
+@ROUTER.action("metrics_summary")
+def metrics_summary():
+    return {'msg': "Success",'enabled': METRICS.enabled,'stages': METRICS.summary()}
+# ==========================================================================
+# Actions without parameter
+# 新增action name即可
+@ROUTER.action("show_list")
+def show_list():
+    global count
+    count+=1
+    print(count)
+    json_string={
+        'msg': pose_list
+    }
+    return json_string
+@ROUTER.action("sayhi")
+def sayhi():
+    return prediction
+# ==========================================================================
+# Actions with parameter
+@ROUTER.action('takepic',mode='thread',limit=1,group='camera',parameter=True)
+def takepic(action_parameter):
     # =========================================================
     # 這個主要是將照片存在MaskRCNN的training路徑，但假如沒有需要訓練 可以註解 那照片將會存在當前目錄下
     base_dir="Models/MaskRCNN/samples/mydataset/graspingitem/"
     # =========================================================
-    # 基本上 裡面可以用來處理任何邏輯運算 以及需要執行甚麼動作
-    print(action_name,action_parameter)
-    if action_name==None:
-        abort(404)
-    # 假如有其他action需要parameter 則加入其他elif條件即可
-    elif(action_name=='takepic'):
-        # 這邊的action parameter就是folder name
-        folder_name=action_parameter
-        save_path=base_dir+folder_name
-        print(save_path)
-        if os.path.isdir(save_path):
-            print("The photo is saving in: /",save_path)
-        else:
-            os.makedirs(save_path)
-        # Take picture setting up
+    # 這邊的action parameter就是folder name
+    folder_name=action_parameter
+    save_path=base_dir+folder_name
+    print(save_path)
+    if os.path.isdir(save_path):
+        print("The photo is saving in: /",save_path)
+    else:
+        os.makedirs(save_path)
+    # Take picture setting up
+    with span('capture'):
         while True:
             ret, frame = cap.read()
             if ret==True:
-                cv2.imwrite(save_path+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",frame)
                 break
-        return jsonify({'msg': "Success"})
-    elif(action_name=="others"):
-        return jsonify({'msg': action_name+action_parameter})
-    else:
-        abort(404)
+    cv2.imwrite(save_path+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",frame)
+    return {'msg': "Success"}
+@ROUTER.action("others",parameter=True)
+def others(action_parameter):
+    return {'msg': "others"+action_parameter}
 
 # ==============================================================================
 # router 最後都希望可以放入 errorhandler處理404的狀況
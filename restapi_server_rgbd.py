@@ -2,26 +2,35 @@ from flask import Flask, jsonify
 from flask import make_response
 from flask import request
 from flask import abort
-import pyrealsense2 as rs
+from flask import Response
 import numpy as np
 import sys
 import os
 import cv2
 import time
 import json
-import tensorflow as tf
+import threading
 import importlib
 import json
-from Models.maskrcnn_mask_generator import MaskGenerator
-from multiprocessing import Process,Pool
+from Models.maskrcnn_worker import MaskRCNNWorker
+from Models.maskrcnn_paths import MODEL_PATH
+from Models.mask_cache import MaskCache
 from ra605.arm_kinematic import *
+from ra605.reachability import ReachabilityMap,REACHABILITY_MAP_PATH
 from Config.realsense_config import RGBDCamera,HAND_EYE_TFMATRIX
 from Utils.point_cloud_tool import *
+from Utils.realsense_capture import RealsenseCaptureService
+from Utils.action_router import ActionRouter,report_stage
+from Utils.exploration_pipeline import ExplorationPipeline,VIEW_STAGES
+from Utils.voxel_accumulator import VoxelHashAccumulator
+from Utils.tsdf_fusion import MaskedTSDFVolume,save_mesh_to_ply
+from Utils.metrics import METRICS,span
 # ignore warning
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 # ===============================================================
-# Multithread function for detecting mask from MaskRCNN
+# Function for detecting mask from MaskRCNN
+# The model stays in the MASK_WORKER process, so it is only loaded once
 # How to use?
 """
 Send in data as this format:
@@ -32,35 +41,51 @@ data={
 }
 """
 def detect_mask_function(data):
-    tf.reset_default_graph()
-    MASK_GENERATOR=MaskGenerator(CLASS_NAME)
-    MASK_GENERATOR.load_model()
-    mask=MASK_GENERATOR.generateMask(data['target_label'],data['image'])
-    mask_binary=np.where(mask==1,255,0)
-    cv2.imwrite(data['target_label']+".png",mask_binary)
+    # identical frames(replayed sessions, test images) are answered from the cache
+    with span('detect'):
+        mask=MASK_CACHE.get_or_compute(data['image'],data['target_label'],MASK_WORKER.generate_mask)
+    if mask is None:
+        print("找不到 %s 的mask" % data['target_label'])
+        return None
+    cv2.imwrite(data['target_label']+".png",mask.to_dense()*255)
     # partial point cloud 太少的話 就回傳none
-    print("mask的點數為： %d" %(len(np.where(mask==1)[0]),))
-    if(len(np.where(mask==1)[0])<2500):
+    # CompactMask已經算好點數 不用再np.where整張frame
+    print("mask的點數為： %d" %(mask.count,))
+    if(mask.count<2500):
         mask=None
-    # realse data from gpu
-    print(mask)
-    tf.keras.backend.clear_session()
-    del MASK_GENERATOR
     return mask
 
 # ===============================================================
 # load pointnet
-pn_graph=tf.Graph()
-with pn_graph.as_default():
-    c=tf.constant(5.0)
-    assert c.graph is pn_graph
+# tensorflow takes seconds to import, so the graph is only built by the first action using it
+# (the server answers start_stream right after a restart)
+PN_GRAPH=None
+PN_GRAPH_LOCK=threading.Lock()
+def get_pn_graph():
+    global PN_GRAPH
+    with PN_GRAPH_LOCK:
+        if PN_GRAPH is None:
+            import tensorflow as tf
+            graph=tf.Graph()
+            with graph.as_default():
+                c=tf.constant(5.0)
+                assert c.graph is graph
+            PN_GRAPH=graph
+    return PN_GRAPH
 
 # ================================================================
 # load MaskRCNN Model
 # HERE NEED TO SET UP ALL PARAMETER BY YOURSELF. SOMETHING YOU WANT TO GRASP
 CLASS_NAME = ['BG', 'apple','banana','box','cup','tape']
-
-MASK_GENERATOR=None
+# resident worker process, started by start_detector or the first detection
+# 多個cell/camera同時打這台server時 可以把batch size調大 一次model.detect處理多張frame
+# (batch size 1 的延遲最低，但request只能一個一個排隊)
+MASK_BATCH_SIZE=1
+MASK_WORKER=MaskRCNNWorker(CLASS_NAME,batch_size=MASK_BATCH_SIZE)
+# True: load MaskRCNN in the background as soon as the server is up, the first detection does not wait
+PREWARM_DETECTOR=False
+# results of MASK_WORKER on disk, keyed by image, weights and label
+MASK_CACHE=MaskCache("mask_cache",MODEL_PATH)
 # ----------------------------------------------------------------
 # Global variable
 POINT_CLOUD_PATH_FILE="pc_file_train01.json"
@@ -72,16 +97,26 @@ depth_list=[]
 mask_list=[]
 detect_count=0
 SAVE_DIRECTORY="pointnet_data_v3"
+# build it once with `python -m ra605.reachability`, it is loaded with mmap
+REACHABILITY_MAP=None
+if os.path.isfile(REACHABILITY_MAP_PATH+".npy"):
+    REACHABILITY_MAP=ReachabilityMap.load(REACHABILITY_MAP_PATH)
 app = Flask(__name__)
 # =================================================================
 # Parameters
 # Configure depth and color streams for realsense d435
-pipeline = rs.pipeline()
-config = rs.config()
-config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
-align_to = rs.stream.color
-align = rs.align(align_to)
+# pyrealsense2 is imported and the pipeline created by the first start_stream
+def create_realsense_pipeline():
+    import pyrealsense2 as rs
+    pipeline = rs.pipeline()
+    config = rs.config()
+    config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
+    config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+    align_to = rs.stream.color
+    align = rs.align(align_to)
+    return pipeline,config,align
+# background thread keeping the newest aligned color+depth pairs
+CAPTURE=RealsenseCaptureService(factory=create_realsense_pipeline)
 # ==================================================================
 
 # testing data
@@ -191,238 +226,410 @@ def delete_task(task_id):
 # ============================================================================
 # 控制器希望PC這邊做甚麼事情
 # Action controller
+# 每個action都是註冊在ROUTER裡的function (Utils/action_router.py)，不再是一長串elif
+# mode: inline在request thread直接執行, thread丟到該group的thread pool
+# limit/group: 同一個group同時最多只能跑limit個，例如相機一次只拍一張
+# 在url後面加上 ?async=1 就會馬上回傳job_id，之後用 /todo/api/v1.0/jobs/<job_id> 查詢結果
+# 所以LabVIEW polling check_image_number的時候 不會卡在5秒的detection後面
+ROUTER=ActionRouter()
+# long-poll/SSE 最多等幾秒
+JOB_MAX_WAIT=30
+# pose_list,color_list,depth_list,mask_list 會被不同thread的action讀寫
+SESSION_LOCK=threading.Lock()
+def clear_session():
+    pose_list.clear()
+    color_list.clear()
+    depth_list.clear()
+    mask_list.clear()
+def run_action(action_name,action_parameter=None):
+    if not ROUTER.has_action(action_name,action_parameter is not None):
+        abort(404)
+    if request.args.get('async'):
+        job_id=ROUTER.submit(action_name,action_parameter)
+        return jsonify({'msg': "Submitted",'job_id': job_id}),202
+    return jsonify(ROUTER.dispatch(action_name,action_parameter))
 # 純粹希望pc端坐事情的 可以使用action name傳遞 注意後面的/不能夠省略
 @app.route('/todo/api/v1.0/actions/<string:action_name>/', methods=['GET'])
 def take_action(action_name):
-    global pipeline,config,MASK_GENERATOR,REALSENSE_CAMERA,POINT_CLOUD_PATH_FILE,detect_count,SAVE_DIRECTORY
     print("url: '/todo/api/v1.0/actions/<string:action_name>'")
-    if action_name==None:
-        abort(404)
-    # 新增action name即可
-    # In order to turn on the stream in the code you need to let labview to control it through URL
-    # finishing stream can use the same way to complete it.
-    elif action_name=="start_stream":
-        pipeline.start(config)
-        return jsonify({'msg': "start stream"})
-    elif action_name=="finish_stream":
-        if(len(color_list)!=0):
-            pose_list.clear()
-            color_list.clear()
-            depth_list.clear()
-            mask_list.clear()        
-        pipeline.stop()
-        return jsonify({'msg': "finish stream"})
-# ==========================================================================
-    # Code with bugs, not recommend to use it
-    # start an detector object
-    elif action_name=="start_detector":
-
-        tf.reset_default_graph()
-        MASK_GENERATOR=MaskGenerator(CLASS_NAME)
-        MASK_GENERATOR.load_model()
-
-        return jsonify({'msg': "start mask detector"})
-    # finish an detector object
-    elif action_name=="finish_detector":
-        print("Clear all session in the end!!!")
-        # sess=tf.keras.backend.get_session()
-        tf.reset_default_graph()
-        tf.keras.backend.clear_session()
-        del MASK_GENERATOR
-        return jsonify({'msg': "finish mask detector"})
-    elif action_name=="test_detector":
-        # bgr type
-        print(tf.keras.backend.get_session())
-        image=cv2.imread('./color4.png')
-        print(image.shape)
-        # rgb == skimage
-        image=image[:,:,::-1]
-        target_label="tape"
-        mask=MASK_GENERATOR.generateMask(target_label,image)
-        mask_binary=np.where(mask==1,255,0)
-        cv2.imwrite("mask.png",mask_binary)
-        return jsonify({'msg': "Sucessfully detect mask from model1"})
-# ==========================================================================
-    # testing multithread with MaskRCNN model
-    elif action_name=="multithread":
-        data={}
-
-        image=cv2.imread('./frame-09-10-2019-11-40-23.png')
-        print(image.shape)
-        # rgb == skimage
-        image=image[:,:,::-1]
-        data['image']=image
-        data['target_label']="banana"
-        pool=Pool(1)
-        mask_list.append(pool.apply(detect_mask_function,(data,)))
-        pool.close()
-        pool.join()
-        del pool
-        return jsonify({'msg': "multithread test!!!"})
-    # ===============================================================================
-    # 這個action主要用來處理儲存的問題
-    elif action_name=="check_image_number":
-        """
-        Because I want to do 3d-reconstruction, I need to check the length of image
-        should be at least two.
-        """
-        print("現在的照片有： %s 張" % str(len(color_list)))
-        print("現在的次數有： %s 次" % str(detect_count))
-        if(len(color_list)==1):
-            # 這邊要儲存partial point cloud file 還有其路徑
-            folder_name=SAVE_DIRECTORY
-            if os.path.isdir(folder_name):
-                print("The point cloud is saving in: /",folder_name)
-            else:
-                os.makedirs(folder_name)
-            ply_points,xyz_points=join_map_with_mask(pose_list,color_list,depth_list,mask_list,REALSENSE_CAMERA)
-            if(xyz_points.shape[0]>=4000):
-                file_name=time.strftime("%d-%m-%Y-%H-%M-%S")
-                full_json_path='./'+folder_name+'/'+POINT_CLOUD_PATH_FILE
-                pc_json_file=open(full_json_path,'r')
-                path_list=json.load(pc_json_file)
-                full_path_name=folder_name+"/"+file_name+".ply"
-                print(full_path_name)
-                print(type(path_list))
-                path_list.append(full_path_name)
-                pc_json_file.close()
-                pc_json_file=open(full_json_path,'w')
-                json.dump(path_list,pc_json_file)
-                pc_json_file.close()
-                savePoints_to_ply(folder_name,file_name+".ply",ply_points)
-                pose_list.clear()
-                color_list.clear()
-                depth_list.clear()
-                mask_list.clear()
-                if(detect_count==5):
-                    detect_count=0
-                    return jsonify({'msg': "Yes"})
-                return jsonify({'msg': "No"})
-            else:
-                pose_list.clear()
-                color_list.clear()
-                depth_list.clear()
-                mask_list.clear()
-                return jsonify({'msg': "No"})                
-        else:
-            return jsonify({'msg': "No"})
-    # ==========================================================================
-    elif action_name=="sayhi":
-        # 每次讀入的session都不一樣位址
-        print(len(mask_list))
-        print(mask_list[0].shape)
-        # with tf.Session(graph=pn_graph) as sess:
-        #     print(sess)
-        #     print("graph name is: ",pn_graph)
-        #     print(sess.run(c))
-        return jsonify({'msg': "Hello"})
-    else:
-        abort(404)
-    # ==========================================================================
-
+    return run_action(action_name)
 """
 這裡面的寫法必須注意的事情有：
 1.要進來這個route就是必須傳遞parameter，否則會走上面那個路徑
 labview端就不需要傳參數給action parameter
-2.新增方法的話只要新增elif的條件判斷即可，action parameter就是對應的參數
+2.新增方法的話只要用ROUTER.action(..., parameter=True)註冊即可，action parameter就是對應的參數
 """
 @app.route('/todo/api/v1.0/actions/<string:action_name>/<string:action_parameter>', methods=['GET'])
 def take_action_with_parameter(action_name,action_parameter):
-    global pipeline,config,CURRENT_POSTION,detect_count
     # 基本上 裡面可以用來處理任何邏輯運算 以及需要執行甚麼動作
     print(action_name,action_parameter)
-    # pipeline.start(config)
-    time.sleep(1)
-    if action_name==None:
+    return run_action(action_name,action_parameter)
+# 查詢 ?async=1 送出的action
+# state: queued/running/done/failed, result就是action原本會回傳的json
+# long-poll: ?wait=10 最多等10秒直到job結束, 加上 &stage=captured 則是等到那個stage就回傳
+# ex: 送出get_photo_and_mask之後 等到captured手臂就可以先移動到下一個viewpoint
+@app.route('/todo/api/v1.0/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        wait=float(request.args.get('wait',0))
+    except ValueError:
+        abort(400)
+    # nan也算錯誤的參數, 負的就是不等
+    if wait!=wait:
+        abort(400)
+    wait=min(max(wait,0.0),JOB_MAX_WAIT)
+    if wait>0:
+        job=ROUTER.wait(job_id,wait,request.args.get('stage'))
+    else:
+        job=ROUTER.job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify({'job': job})
+# Server-Sent Events: 每個stage發生時就推一個event
+# get_photo_and_mask: running, captured, masked, view_stored, done/failed
+# explore_view: running, captured, masked, cloud_ready(已經fuse進點雲), done/failed
+@app.route('/todo/api/v1.0/jobs/<string:job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    if ROUTER.job(job_id) is None:
         abort(404)
-    # 假如有其他action需要parameter 則加入其他elif條件即可
-    elif(action_name=='takepic'):
-        # 這邊的action parameter就是folder name
-        folder_name=action_parameter
+    def generate():
+        for event in ROUTER.iter_events(job_id,timeout=JOB_MAX_WAIT):
+            yield "event: %s\ndata: %s\n\n" % (event['stage'],json.dumps(event))
+    return Response(generate(),mimetype='text/event-stream',headers={'Cache-Control': 'no-cache'})
+# ==========================================================================
+# Latency of every stage (Utils/metrics.py): capture, align, detect, back_project, fuse,
+# ply_write, json_index. /metrics 給Prometheus抓, metrics_summary/ 是json版
+# METRICS_ENABLED=False 的時候span幾乎不花時間
+METRICS_ENABLED=True
+METRICS.enabled=METRICS_ENABLED
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(METRICS.prometheus_text(),content_type='text/plain; version=0.0.4; charset=utf-8')
+@ROUTER.action("metrics_summary")
+def metrics_summary():
+    return {'msg': "Success",'enabled': METRICS.enabled,'stages': METRICS.summary()}
+@ROUTER.action("reset_metrics")
+def reset_metrics():
+    METRICS.reset()
+    return {'msg': "Success"}
+# ==========================================================================
+# Actions without parameter
+# In order to turn on the stream in the code you need to let labview to control it through URL
+# finishing stream can use the same way to complete it.
+@ROUTER.action("start_stream")
+def start_stream():
+    CAPTURE.start()
+    return {'msg': "start stream"}
+@ROUTER.action("finish_stream")
+def finish_stream():
+    with SESSION_LOCK:
+        clear_session()
+    CAPTURE.stop()
+    return {'msg': "finish stream"}
+# ==========================================================================
+# start the detector worker before the first detection(pre-warm)
+@ROUTER.action("start_detector",mode='thread',limit=1,group='detector')
+def start_detector():
+    MASK_WORKER.start()
+    return {'msg': "start mask detector"}
+# finish the detector worker, its gpu memory is released with the process
+@ROUTER.action("finish_detector",mode='thread',limit=1,group='detector')
+def finish_detector():
+    MASK_WORKER.stop()
+    return {'msg': "finish mask detector"}
+@ROUTER.action("test_detector",mode='thread')
+def test_detector():
+    # bgr type
+    image=cv2.imread('./color4.png')
+    print(image.shape)
+    # rgb == skimage
+    image=image[:,:,::-1]
+    target_label="tape"
+    mask=MASK_CACHE.get_or_compute(image,target_label,MASK_WORKER.generate_mask)
+    if mask is not None:
+        cv2.imwrite("mask.png",mask.to_dense()*255)
+    return {'msg': "Sucessfully detect mask from model1"}
+# ==========================================================================
+# testing multithread with MaskRCNN model
+@ROUTER.action("multithread",mode='thread')
+def multithread():
+    data={}
+
+    image=cv2.imread('./frame-09-10-2019-11-40-23.png')
+    print(image.shape)
+    # rgb == skimage
+    image=image[:,:,::-1]
+    data['image']=image
+    data['target_label']="banana"
+    mask=detect_mask_function(data)
+    with SESSION_LOCK:
+        mask_list.append(mask)
+    return {'msg': "multithread test!!!"}
+# ===============================================================================
+# 這個action主要用來處理儲存的問題
+@ROUTER.action("check_image_number",limit=1)
+def check_image_number():
+    """
+    Because I want to do 3d-reconstruction, I need to check the length of image
+    should be at least two.
+    """
+    global detect_count
+    with SESSION_LOCK:
+        print("現在的照片有： %s 張" % str(len(color_list)))
+        print("現在的次數有： %s 次" % str(detect_count))
+        if(len(color_list)==0):
+            return {'msg': "No"}
+        # 這邊要儲存partial point cloud file 還有其路徑
+        folder_name=SAVE_DIRECTORY
         if os.path.isdir(folder_name):
-            print("The photo is saving in: /",folder_name)
+            print("The point cloud is saving in: /",folder_name)
         else:
             os.makedirs(folder_name)
-        # Take picture setting up
-        # ====================================
-        # replace by rgbd setting up
-        # while True:
-        #     ret, frame = cap.read()
-        #     if ret==True:
-        #         cv2.imwrite(folder_name+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",frame)
-        #         break
-
-        while True:
-            frames = pipeline.wait_for_frames()
-            color_frame = frames.get_color_frame()
-            if color_frame:
-                color_image = np.asanyarray(color_frame.get_data())
-                cv2.imwrite(folder_name+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",color_image)
-                # pipeline.stop()
-                break
-                
-        return jsonify({'msg': "Success"})
-    # ---------------------------------------------------------------------
-    # 寫exploration algorithm的方法:
-    # photo including color and depth map
-    elif(action_name=="get_photo_and_mask"):
-        if(action_parameter not in CLASS_NAME):
-            return jsonify({'msg': "Failed WITH WRONG Parameter!"})
-        color_image=None
-        while True:
-            # Get frameset of color and depth
-            frames = pipeline.wait_for_frames()
-            # frames.get_depth_frame() is a 640x360 depth image
-            
-            # Align the depth frame to color frame
-            aligned_frames = align.process(frames)
-            
-            # Get aligned frames
-            aligned_depth_frame = aligned_frames.get_depth_frame() # aligned_depth_frame is a 640x480 depth image
-            color_frame = aligned_frames.get_color_frame()
-            
-            # Validate that both frames are valid
-            if not aligned_depth_frame or not color_frame:
+        # get_photo_and_mask 可以同時跑兩個 所以這時候可能已經存了不只一個view
+        # 每個view還是各自存一個partial point cloud, 全部處理完才清空 不會卡住之後的check
+        views=list(zip(pose_list,color_list,depth_list,mask_list))
+        clear_session()
+        saved=0
+        for i,(pose,color,depth,mask) in enumerate(views):
+            xyz_points,rgb_points=fuse_masked_views([pose],[color],[depth],[mask],REALSENSE_CAMERA)
+            if(xyz_points.shape[0]<4000):
                 continue
-            
-            if color_frame:
-                depth_image = np.asanyarray(aligned_depth_frame.get_data())
-                color_image = np.asanyarray(color_frame.get_data())
-                cv2.imwrite(SAVE_DIRECTORY+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",color_image)
-                cv2.imwrite("_color2.png",color_image)
-                cv2.imwrite("_dep2.png",depth_image)
-                break
-        target_label=str(action_parameter)
-        data={}
-        # bgr to rgb for detection
-        image=color_image[:,:,::-1]
-        data['image']=image
-        data['target_label']=target_label
-        pool=Pool(1)
-        mask=pool.apply(detect_mask_function,(data,))
-        pool.close()
-        pool.join()
-        del pool
-        if(mask is not None):
-            # 換成用image套件讀入
-            # color要傳入 rgb的img
-            color_img = Image.fromarray(image.astype('uint8'), 'RGB')
-            depth_img = Image.fromarray(depth_image)
-            mask_img = Image.fromarray(np.uint8(mask))
-            # 儲存起來所有資訊
-            mask_list.append(mask_img)
-            color_list.append(color_img)
-            depth_list.append(depth_img)
-            pose_list.append(CURRENT_POSTION)
-            detect_count+=1
-            return jsonify({'msg': "Successfully detect mask"})
-        else:
-            detect_count+=1
-            return jsonify({'msg': "Failed"})
-    elif(action_name=="others"):
-        return jsonify({'msg': action_name+action_parameter})
+            save_point_cloud_file(folder_name,xyz_points,rgb_points,suffix="" if i==0 else "-%d" % i)
+            saved+=1
+        if(saved==0):
+            return {'msg': "No"}
+        if(detect_count>=5):
+            detect_count=0
+            return {'msg': "Yes"}
+        return {'msg': "No"}
+# 存ply 並把路徑加到POINT_CLOUD_PATH_FILE(json)裡
+# suffix: 同一秒存好幾個view的時候 檔名不會重複
+def save_point_cloud_file(folder_name,xyz_points,rgb_points,suffix=""):
+    file_name=time.strftime("%d-%m-%Y-%H-%M-%S")+suffix
+    full_json_path='./'+folder_name+'/'+POINT_CLOUD_PATH_FILE
+    full_path_name=folder_name+"/"+file_name+".ply"
+    with span('json_index'):
+        pc_json_file=open(full_json_path,'r')
+        path_list=json.load(pc_json_file)
+        print(full_path_name)
+        print(type(path_list))
+        path_list.append(full_path_name)
+        pc_json_file.close()
+        pc_json_file=open(full_json_path,'w')
+        json.dump(path_list,pc_json_file)
+        pc_json_file.close()
+    save_pointcloud_to_ply(folder_name,file_name+".ply",xyz_points,rgb_points)
+    return full_path_name
+# ==========================================================================
+# Pipelined exploration (Utils/exploration_pipeline.py)
+# capture, detection, fusion 各自在自己的thread 每個view的mask一出來就fuse進點雲
+# 1. explore_view/<label>?async=1 每個viewpoint送一次 等到captured手臂就可以移動
+# 2. finish_exploration/ 等最後一個view fuse完 存ply
+def grab_exploration_view(request_time):
+    frame=CAPTURE.latest(newer_than=request_time)
+    # 拍照當下的pose, bgr to rgb
+    return np.ascontiguousarray(frame.color[:,:,::-1]),frame.depth,CURRENT_POSTION
+def detect_exploration_mask(image,target_label):
+    return detect_mask_function({'image':image,'target_label':target_label})
+# 'points': 每個view直接fuse進voxel hash(一個voxel一個點) 點雲不會一直重複長大 也不用再down sample
+# 'tsdf'  : 只在mask的frustum裡做TSDF fusion 深度雜訊會被平均掉 finish_exploration存的是表面的點
+#           export_mesh/ 可以另外存成mesh(需要scikit-image)
+RECONSTRUCTION_MODE='points'
+FUSION_VOXEL_SIZE=0.001
+TSDF_VOXEL_SIZE=0.002
+TSDF_EXTENT=0.3
+if RECONSTRUCTION_MODE=='tsdf':
+    EXPLORATION=ExplorationPipeline(grab_exploration_view,detect_exploration_mask,REALSENSE_CAMERA,
+                                    volume=MaskedTSDFVolume(voxel_size=TSDF_VOXEL_SIZE,extent=TSDF_EXTENT))
+else:
+    EXPLORATION=ExplorationPipeline(grab_exploration_view,detect_exploration_mask,REALSENSE_CAMERA,
+                                    accumulator=VoxelHashAccumulator(FUSION_VOXEL_SIZE))
+# 在finish_exploration之前呼叫 (finish會reset volume)
+@ROUTER.action("export_mesh",mode='thread',limit=1,group='exploration')
+def export_mesh():
+    if EXPLORATION.volume is None:
+        raise Exception("export_mesh needs RECONSTRUCTION_MODE='tsdf'.")
+    EXPLORATION.finish(timeout=JOB_MAX_WAIT)
+    vertices,faces,colors=EXPLORATION.volume.extract_mesh()
+    folder_name=SAVE_DIRECTORY
+    if not os.path.isdir(folder_name):
+        os.makedirs(folder_name)
+    path=folder_name+"/"+time.strftime("%d-%m-%Y-%H-%M-%S")+"_mesh.ply"
+    save_mesh_to_ply(path,vertices,faces,colors)
+    return {'msg': "Yes",'vertices': int(len(vertices)),'faces': int(len(faces)),'path': path}
+@ROUTER.action("finish_exploration",mode='thread',limit=1,group='exploration')
+def finish_exploration():
+    xyz_points,rgb_points=EXPLORATION.finish(timeout=JOB_MAX_WAIT)
+    views=[view.summary() for view in EXPLORATION.views()]
+    EXPLORATION.reset()
+    if(xyz_points.shape[0]<4000):
+        return {'msg': "No",'points': int(xyz_points.shape[0]),'views': views}
+    folder_name=SAVE_DIRECTORY
+    if not os.path.isdir(folder_name):
+        os.makedirs(folder_name)
+    path=save_point_cloud_file(folder_name,xyz_points,rgb_points)
+    return {'msg': "Yes",'points': int(xyz_points.shape[0]),'path': path,'views': views}
+# ==========================================================================
+@ROUTER.action("sayhi")
+def sayhi():
+    # 每次讀入的session都不一樣位址
+    print(len(mask_list))
+    if mask_list:
+        print(mask_list[0])
+    # with tf.Session(graph=get_pn_graph()) as sess:
+    #     print(sess)
+    #     print("graph name is: ",get_pn_graph())
+    #     print(sess.run(c))
+    return {'msg': "Hello"}
+# ==========================================================================
+# Actions with parameter
+@ROUTER.action('takepic',mode='thread',limit=1,group='camera',parameter=True)
+def takepic(action_parameter):
+    # 只用request進來之後拍到的frame 取代原本的time.sleep(1)
+    request_time=time.time()
+    # 這邊的action parameter就是folder name
+    folder_name=action_parameter
+    if os.path.isdir(folder_name):
+        print("The photo is saving in: /",folder_name)
     else:
-        abort(404)
+        os.makedirs(folder_name)
+    # Take picture setting up
+    # ====================================
+    # replace by rgbd setting up
+    # while True:
+    #     ret, frame = cap.read()
+    #     if ret==True:
+    #         cv2.imwrite(folder_name+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",frame)
+    #         break
+    frame=CAPTURE.latest(newer_than=request_time)
+    cv2.imwrite(folder_name+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",frame.color)
+    return {'msg': "Success"}
+# ---------------------------------------------------------------------
+# 寫exploration algorithm的方法:
+# photo including color and depth map
+# 用 ?async=1 送出的話 會依序回報 captured -> masked -> view_stored 這幾個stage
+# view_stored: view存進list了 點雲要等check_image_number才會fuse
+# captured之後手臂就可以移動 detection跟手臂移動同時進行
+# 不放在camera group: 上一個view還在detection的時候 下一個view就可以先拍
+@ROUTER.action("get_photo_and_mask",mode='thread',limit=2,group='detection',parameter=True)
+def get_photo_and_mask(action_parameter):
+    global detect_count
+    request_time=time.time()
+    if(action_parameter not in CLASS_NAME):
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    # 拍照當下的pose 不會被detection期間送進來的6dof蓋掉
+    pose=CURRENT_POSTION
+    # Get the newest aligned color and depth (640x480) from the capture thread
+    frame=CAPTURE.latest(newer_than=request_time)
+    report_stage('captured',frame_number=frame.frame_number,host_time=frame.host_time)
+    depth_image=frame.depth
+    color_image=frame.color
+    cv2.imwrite(SAVE_DIRECTORY+"/"+"frame-" + time.strftime("%d-%m-%Y-%H-%M-%S") + ".png",color_image)
+    cv2.imwrite("_color2.png",color_image)
+    cv2.imwrite("_dep2.png",depth_image)
+    target_label=str(action_parameter)
+    data={}
+    # bgr to rgb for detection
+    image=color_image[:,:,::-1]
+    data['image']=image
+    data['target_label']=target_label
+    mask=detect_mask_function(data)
+    report_stage('masked',found=mask is not None,pixels=0 if mask is None else mask.count)
+    with SESSION_LOCK:
+        detect_count+=1
+        if(mask is None):
+            return {'msg': "Failed"}
+        # 直接存CompactMask 給fuse_masked_views使用(只佔幾KB)
+        # color要傳入 rgb的img
+        # 儲存起來所有資訊
+        mask_list.append(mask)
+        color_list.append(np.ascontiguousarray(image,dtype=np.uint8))
+        depth_list.append(depth_image)
+        pose_list.append(pose)
+        views=len(color_list)
+    # 這個view存好了 check_image_number會把它fuse成點雲
+    report_stage('view_stored',views=views)
+    return {'msg': "Successfully detect mask"}
+# ---------------------------------------------------------------------
+# 一次forward pass偵測多個目標
+# action parameter: "cup,tape" 或 "cup,tape:0.8:2" (labels:min_score:top_k)
+@ROUTER.action("detect_targets",mode='thread',limit=1,group='camera',parameter=True)
+def detect_targets(action_parameter):
+    request_time=time.time()
+    fields=action_parameter.split(':')
+    labels=fields[0].split(',')
+    if any(label not in CLASS_NAME for label in labels) or len(fields)>3:
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    try:
+        min_score=float(fields[1]) if len(fields)>1 else 0.0
+        top_k=int(fields[2]) if len(fields)>2 else None
+    except ValueError:
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    # NaN也會在這裡被擋掉
+    if not 0<=min_score<=1 or (top_k is not None and top_k<1):
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    frame=CAPTURE.latest(newer_than=request_time)
+    # bgr to rgb for detection
+    image=frame.color[:,:,::-1]
+    with span('detect'):
+        instances=MASK_WORKER.generate_masks(labels,image,min_score,top_k)
+    targets={}
+    for label in labels:
+        targets[label]=[]
+        for i,instance in enumerate(instances[label]):
+            mask=instance['mask']
+            cv2.imwrite("%s_%d.png" % (label,i),mask.to_dense()*255)
+            targets[label].append({
+                'score':instance['score'],
+                'bbox':instance['bbox'],
+                'pixels':mask.count
+            })
+    return {'msg': "Success",'targets': targets}
+# ---------------------------------------------------------------------
+# 檢查grasp是否在手臂的工作空間內 (在做IK之前先過濾)
+# action parameter: "x,y,z,ax,ay,az" 位置(mm)跟夾爪的approach方向(t0_6的z軸), base frame
+@ROUTER.action("is_reachable",parameter=True)
+def is_reachable(action_parameter):
+    if REACHABILITY_MAP is None:
+        return {'msg': "Failed WITHOUT reachability map!"}
+    try:
+        values=np.array([float(value) for value in action_parameter.split(',')])
+    except ValueError:
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    if len(values)!=6 or not np.all(np.isfinite(values)):
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    # approach方向要是單位向量 不然direction bin會是NaN
+    approach=values[3:6]
+    norm=np.linalg.norm(approach)
+    if norm==0:
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    t0_6=np.eye(4)
+    t0_6[0:3,3]=values[0:3]
+    t0_6[0:3,2]=approach/norm
+    return {'msg': "Yes" if REACHABILITY_MAP.is_reachable(t0_6) else "No"}
+# 送一個view進exploration pipeline, 回報 captured -> masked -> cloud_ready
+@ROUTER.action("explore_view",mode='thread',group='exploration_view',parameter=True)
+def explore_view(action_parameter):
+    if(action_parameter not in CLASS_NAME):
+        return {'msg': "Failed WITH WRONG Parameter!"}
+    EXPLORATION.start()
+    view=EXPLORATION.request_view(action_parameter)
+    for stage,event in (('captured','captured'),('masked','masked'),('fused','cloud_ready')):
+        view.wait(stage)
+        # the pipeline may already be past stage when we look at it, that still counts as reached
+        state=view.state
+        if state in ('no_mask','failed'):
+            break
+        if VIEW_STAGES.index(state)>=VIEW_STAGES.index(stage):
+            report_stage(event,view=view.index,points=view.points)
+    # the result is only decided once the view ended
+    view.wait_finished()
+    if view.state!='fused':
+        return {'msg': "Failed",'view': view.summary()}
+    return {'msg': "Successfully detect mask",'view': view.summary()}
+@ROUTER.action("others",parameter=True)
+def others(action_parameter):
+    return {'msg': "others"+action_parameter}
 
 # ==============================================================================
 # router 最後都希望可以放入 errorhandler處理404的狀況
@@ -433,6 +640,9 @@ def error_handler(error):
 if __name__ == '__main__':
 
     DEBUG_MODE=True
+    # with debug the reloader runs this file twice, only the serving process loads the model
+    if PREWARM_DETECTOR and (not DEBUG_MODE or os.environ.get('WERKZEUG_RUN_MAIN')=='true'):
+        threading.Thread(target=MASK_WORKER.start,name="prewarm-detector",daemon=True).start()
     app.run(host='0.0.0.0',port=12345,debug = DEBUG_MODE)
 
 